@@ -376,6 +376,7 @@ if __name__ == "__main__":
     argparser.add_argument('--resample', type=str2bool, nargs='?', const=True, default=False, help='use resampling during training')
     argparser.add_argument('--alpha_resample_ratio', type=float, default=0.5, help='alpha=0: uniform sampling (ignoring weights) and alpha=1: standard hard sampling (produces zero gradients)')
     argparser.add_argument('--resample_threshold', type=float, default=0.5, help='resample_threshold=1 means resample every step and resample_threshold=0.01 means almost never')
+    argparser.add_argument('--resample_scheme', type=str, default='multinomial', help='options: [multinomial, stratified, systematic]')
     argparser.add_argument('--trajlen', type=int, default=25, help='trajectory length to train [max 100]')
     argparser.add_argument('--seglen', type=int, default=5, help='short train segement length to train [max 100]')
     argparser.add_argument('--init_particles_distr', type=str, default='gaussian', help='options: [gaussian, uniform]')
@@ -351,11 +351,6 @@ class TransitionModel(nn.Module):
         self.dummy_param = nn.Parameter(torch.empty(0))
 
     def forward(self, particle_states: Tensor, odometry: Tensor) -> Tensor:
-        if self.params.dataparallel:
-            device = self.dummy_param.get_device()
-        else:
-            device = self.params.rank
-
         translation_std = self.params.transition_std[0] / self.params.map_pixel_in_meters  # in pixels
         rotation_std = self.params.transition_std[1]  # in radians
 
@@ -366,7 +361,7 @@ class TransitionModel(nn.Module):
         odom_x, odom_y, odom_th = torch.unbind(odometry, dim=-1)
         odom_th = normalize(odom_th, isTensor=True)
 
-        noise_th = normalize(torch.normal(mean=0.0, std=1.0, size=part_th.shape).to(device) * rotation_std, isTensor=True)
+        noise_th = normalize(torch.randn_like(part_th) * rotation_std, isTensor=True)
 
         # add orientation noise before translation
         part_th = normalize(part_th + noise_th, isTensor=True)
@@ -377,8 +372,8 @@ class TransitionModel(nn.Module):
         delta_y = sin_th * odom_x + cos_th * odom_y
         delta_th = odom_th
 
-        delta_x = delta_x + torch.normal(mean=0.0, std=1.0, size=delta_x.shape).to(device) * translation_std
-        delta_y = delta_y + torch.normal(mean=0.0, std=1.0, size=delta_y.shape).to(device) * translation_std
+        delta_x = delta_x + torch.randn_like(delta_x) * translation_std
+        delta_y = delta_y + torch.randn_like(delta_y) * translation_std
 
         return torch.stack([part_x + delta_x, part_y + delta_y, normalize(part_th + delta_th, isTensor=True)], axis=-1)
 
@@ -696,10 +691,10 @@ class LocallyConnected2d(nn.Module):
         dh, dw = self.stride
         x = x.unfold(2, kh, dh).unfold(3, kw, dw)
         x = x.contiguous().view(*x.size()[:-2], -1)
-        # Sum in in_channel and kernel_size dims
-        out = (x.unsqueeze(1) * self.weight).sum([2, -1])
+        # Sum in in_channel and kernel_size dims, contracted without building the broadcast product
+        out = torch.einsum('nchwk,ochwk->nohw', x, self.weight[0])
         if self.bias is not None:
-            out += self.bias
+            out = out + self.bias
         return out
 
 class SpatialTransformerNet(nn.Module):
@@ -711,20 +706,38 @@ class SpatialTransformerNet(nn.Module):
         # to determine device dynamically
         self.dummy_param = nn.Parameter(torch.empty(0))
 
-    def forward(self, particle_states: Tensor, global_maps: Tensor) -> Tensor:
-        if self.params.dataparallel:
-            device = self.dummy_param.get_device()
-        else:
-            device = self.params.rank
+        # transform constants keyed by (total_samples, map height, map width, device, dtype), not part of the state dict
+        self.constants = {}
+
+    def transform_constants(self, total_samples, input_map_shape, like):
+        """
+        Constant entries of the transformation matrices, created once per batch shape, device and dtype
+        :param total_samples: batch_size * num_particles
+        :param input_map_shape: shape of the global maps (batch_size, ch, H, W)
+        :param like: tensor whose device and dtype the constants share
+        :return zero, one, scale_x, scale_y: constants (total_samples, )
+        """
+        key = (total_samples, input_map_shape[2], input_map_shape[3], like.device, like.dtype)
+        if key not in self.constants:
+            zero = torch.zeros(total_samples, device=like.device, dtype=like.dtype)
+            one = torch.ones(total_samples, device=like.device, dtype=like.dtype)
+
+            # optional scale down the map
+            window_scaler = 8
+            scale_x = one * (float(self.params.local_map_size[0] * window_scaler) / input_map_shape[3])
+            scale_y = one * (float(self.params.local_map_size[1] * window_scaler) / input_map_shape[2])
+            self.constants[key] = (zero, one, scale_x, scale_y)
+        return self.constants[key]
 
+    def forward(self, particle_states: Tensor, global_maps: Tensor) -> Tensor:
         batch_size, num_particles = particle_states.shape[:2]
         total_samples = batch_size * num_particles
         flat_states = torch.reshape(particle_states, (total_samples, 3))
 
-        zero = torch.full((total_samples, ), 0, dtype=torch.float64).to(device)
-        one = torch.full((total_samples, ), 1, dtype=torch.float64).to(device)
-
+        # constants are cached on the device and in the dtype of the particle states, no host transfer
         input_map_shape = global_maps.shape
+        zero, one, scale_x, scale_y = self.transform_constants(total_samples, input_map_shape, flat_states)
+
         # affine transformation
         height_inverse = 1.0 / input_map_shape[2]
         width_inverse = 1.0 / input_map_shape[3]
@@ -744,9 +757,6 @@ class SpatialTransformerNet(nn.Module):
         rotm = torch.reshape(rotm, (total_samples, 3, 3))
 
         # 3. optional scale down the map
-        window_scaler = 8
-        scale_x = torch.full((total_samples, ), float(self.params.local_map_size[0] * window_scaler) * width_inverse, dtype=torch.float64).to(device)
-        scale_y = torch.full((total_samples, ), float(self.params.local_map_size[1] * window_scaler) * height_inverse, dtype=torch.float64).to(device)
         scalem = torch.stack([scale_x, zero, zero, zero, scale_y, zero, zero, zero, one], axis=1)
         scalem = torch.reshape(scalem, (total_samples, 3, 3))
 
@@ -760,29 +770,18 @@ class SpatialTransformerNet(nn.Module):
         transform_m = torch.matmul(transform_m, scalem) # scale
         # transform_m = torch.matmul(transform_m, transm2)
 
-        # # reshape to the format expected by the spatial transform network
-        # transform_m = torch.reshape(transform_m[:, :2], (batch_size * num_particles, 2, 3))
-        # grid_size = torch.Size((batch_size * num_particles, input_map_shape[1], self.params.local_map_size[0], self.params.local_map_size[1]))
-        # grid = F.affine_grid(transform_m, grid_size, align_corners=False).float()
-        #
-        # output_list = []
-        # # iterate over num_particles
-        # for i in range(num_particles):
-        #     local_map = F.grid_sample(global_maps, grid[i*batch_size: (i+1)*batch_size, :, :, :], align_corners=False)
-        #     output_list.append(local_map)
-        # local_maps = torch.stack(output_list, axis=1)
-
         # reshape to the format expected by the spatial transform network
-        transform_m = torch.reshape(transform_m[:, :2], (batch_size, num_particles, 2, 3))
-
-        output_list = []
-        # iterate over num_particles
-        for i in range(num_particles):
-            grid_size = torch.Size((batch_size, input_map_shape[1], self.params.local_map_size[0], self.params.local_map_size[1]))
-            grid = F.affine_grid(transform_m[:, i], grid_size, align_corners=False).float()
-            local_map = F.grid_sample(global_maps, grid, align_corners=False)
-            output_list.append(local_map)
-        local_maps = torch.stack(output_list, axis=1)
+        transform_m = torch.reshape(transform_m[:, :2], (total_samples, 2, 3))
+        local_map_h, local_map_w = self.params.local_map_size[:2]
+        grid_size = torch.Size((total_samples, input_map_shape[1], local_map_h, local_map_w))
+        grid = F.affine_grid(transform_m, grid_size, align_corners=False)   # [batch_size*num_particles, 28, 28, 2]
+
+        # stack the particle grids of a batch element along the height, s.t. a single grid_sample call
+        # samples all particles from the (not replicated) global map of their batch element
+        grid = torch.reshape(grid, (batch_size, num_particles * local_map_h, local_map_w, 2))
+        local_maps = F.grid_sample(global_maps, grid.to(global_maps.dtype), align_corners=False)  # [batch_size, 1, num_particles*28, 28]
+        local_maps = torch.reshape(local_maps, (batch_size, input_map_shape[1], num_particles, local_map_h, local_map_w))
+        local_maps = local_maps.transpose(1, 2)
 
         return local_maps # [batch_size, num_particles, 1, 28, 28]
 
@@ -796,11 +795,6 @@ class ResampleNet(nn.Module):
         self.dummy_param = nn.Parameter(torch.empty(0))
 
     def forward(self, particle_states: Tensor, particle_weights: Tensor, alpha: int) -> Tensor:
-        if self.params.dataparallel:
-            device = self.dummy_param.get_device()
-        else:
-            device = self.params.rank
-
         assert 0.0 < alpha <= 1.0
         batch_size, num_particles = particle_states.shape[:2]
 
@@ -808,7 +802,7 @@ class ResampleNet(nn.Module):
         particle_weights = particle_weights - torch.logsumexp(particle_weights, dim=-1, keepdim=True)
 
         # construct uniform weights
-        uniform_weights = torch.full((batch_size, num_particles), np.log(1.0/float(num_particles))).to(device)
+        uniform_weights = torch.full_like(particle_weights, np.log(1.0/float(num_particles)))
 
         # build sampling distribution q(s) and update particle weights
         if alpha < 1.0:
@@ -823,16 +817,10 @@ class ResampleNet(nn.Module):
             particle_weights = uniform_weights
 
         # sample particle indices according to q(s) using q_weights
-        m = torch.distributions.categorical.Categorical(logits=q_weights)
-        idx = []
-        # iterate over num_particles
-        for _ in range(num_particles):
-            sample = m.sample() #   [batch_size]
-            idx.append(sample.unsqueeze(1))
-        indices = torch.cat(idx, dim=-1)    #   [batch_size, num_particles]
+        indices = self.sample_indices(q_weights)    #   [batch_size, num_particles]
 
         # index into particles
-        helper = torch.arange(0, batch_size * num_particles, step=num_particles, dtype=torch.int64).to(device) # [batch_size]
+        helper = torch.arange(0, batch_size * num_particles, step=num_particles, dtype=torch.int64, device=indices.device) # [batch_size]
         indices = indices + helper.unsqueeze(1)
 
         indices = torch.reshape(indices, (batch_size * num_particles, ))
@@ -862,6 +850,32 @@ class ResampleNet(nn.Module):
 
         return new_particle_states, new_particle_weights
 
+    def sample_indices(self, q_weights: Tensor) -> Tensor:
+        # inverse cdf sampling: multinomial draws k independent uniforms,
+        # stratified one uniform per stratum, systematic one offset shared by all strata
+        batch_size, num_particles = q_weights.shape[:2]
+        device = q_weights.device
+        scheme = getattr(self.params, 'resample_scheme', 'multinomial')
+
+        if scheme == 'multinomial':
+            u = torch.rand((batch_size, num_particles), device=device)
+        elif scheme == 'stratified':
+            u = torch.rand((batch_size, num_particles), device=device)
+            u = (torch.arange(num_particles, device=device).unsqueeze(0) + u) / num_particles
+        elif scheme == 'systematic':
+            u = torch.rand((batch_size, 1), device=device)
+            u = (torch.arange(num_particles, device=device).unsqueeze(0) + u) / num_particles
+        else:
+            raise ValueError(scheme)
+
+        # normalize cdf s.t. the last entry is exactly 1
+        cdf = torch.cumsum(torch.exp(q_weights), dim=-1)
+        cdf = cdf / cdf[:, -1:]
+        indices = torch.searchsorted(cdf.contiguous(), u.contiguous(), right=True)
+        indices = torch.clamp(indices, max=num_particles - 1)   # guard against round-off
+
+        return indices
+
 class PFCell(nn.Module):
     def __init__(self, params):
         super(PFCell, self).__init__()
@@ -886,12 +900,16 @@ class PFCell(nn.Module):
         lik = self.observation_update(global_maps, particle_states, observation)
         particle_weights = particle_weights + lik  # unnormalized
 
-        # resample selectively based on neff < N/2 threshold
+        # resample selectively per batch element based on neff < N/2 threshold, without host sync
         batch_size, num_particles = particle_states.shape[:2]
         n_eff = self.calc_eff_particles(particle_weights)   # before resample
-        if self.params.resample and n_eff <= num_particles * self.params.resample_threshold:
-            particle_states, particle_weights = self.resample(particle_states, particle_weights)
+        if self.params.resample:
+            resample_mask = n_eff <= num_particles * self.params.resample_threshold    # [batch_size]
+            new_particle_states, new_particle_weights = self.resample(particle_states, particle_weights)
+            particle_states = torch.where(resample_mask[:, None, None], new_particle_states, particle_states)
+            particle_weights = torch.where(resample_mask[:, None], new_particle_weights, particle_weights)
             n_eff = self.calc_eff_particles(particle_weights)   # after resample
+        n_eff = torch.mean(n_eff.detach())
 
         # construct output before motion update
         outputs = particle_states, particle_weights, n_eff
@@ -907,8 +925,8 @@ class PFCell(nn.Module):
     def calc_eff_particles(self, particle_weights):
         # [batch_size, num_particles]
         lin_weights = torch.nn.functional.softmax(particle_weights, dim=-1)
-        n_eff = torch.mean(1 / torch.sum(torch.square(lin_weights), axis=-1))
-        return n_eff.item()    # int
+        n_eff = 1 / torch.sum(torch.square(lin_weights), axis=-1)
+        return n_eff    # [batch_size]
 
     def observation_update(self, global_maps, particle_states, observation):
         batch_size, num_particles = particle_states.shape[:2]
@@ -981,9 +999,46 @@ def plot_grad_flow(named_parameters):
                 Line2D([0], [0], color="k", lw=4)], ['max-gradient', 'mean-gradient', 'zero-gradient'])
     plt.show()
 
+def benchmark_locally_connected(device, batch_size=2, particle_counts=(30, 100, 300)):
+    # compare LocallyConnected2d against the broadcast-and-sum implementation it replaced
+    import time
+
+    def broadcast_forward(model, x):
+        kh, kw = model.kernel_size
+        dh, dw = model.stride
+        x = x.unfold(2, kh, dh).unfold(3, kw, dw)
+        x = x.contiguous().view(*x.size()[:-2], -1)
+        return (x.unsqueeze(1) * model.weight).sum([2, -1]) + model.bias
+
+    model = LocallyConnected2d(24, 8, 12, kernel_size=3, stride=1, bias=True).to(device)
+    for num_particles in particle_counts:
+        x = torch.randn(batch_size * num_particles, 24, 14, 14, device=device)
+        with torch.no_grad():
+            assert torch.allclose(model(x), broadcast_forward(model, x), rtol=1e-4, atol=1e-3)
+
+            for name, forward in [('broadcast', lambda x: broadcast_forward(model, x)), ('einsum', model)]:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                    torch.cuda.reset_peak_memory_stats(device)
+                start = time.time()
+                for _ in range(10):
+                    forward(x)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                    peak_memory = f'{torch.cuda.max_memory_allocated(device) / 2**20:8.1f} MB'
+                else:
+                    peak_memory = 'n/a'
+                print(f'{name:9s} num_particles: {num_particles:4d}, time: {(time.time() - start) / 10 * 1000:8.2f} ms, peak memory: {peak_memory}')
+
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
+    argparser.add_argument('--benchmark_lfc', action='store_true', help='benchmark LocallyConnected2d and exit')
     params = argparser.parse_args()
+
+    if params.benchmark_lfc:
+        benchmark_locally_connected(torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+        exit()
+
     params.num_epochs = 1
     params.batch_size = 2
     params.num_particles = 30
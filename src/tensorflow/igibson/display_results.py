@@ -155,8 +155,15 @@ def display_results(params):
         init_particle_weights = tf.constant(np.log(1.0/float(num_particles)),
                                     shape=(batch_size, num_particles), dtype=tf.float32)
 
+        # map state (feature field, pre-rotated maps or mip level, if enabled) is built once per map and trajectory
+        map_state = obstacle_map
+        if params.map_bank:
+            # bank of the scene maps, each sample looks up its map by index
+            map_state = (obstacle_map, tf.convert_to_tensor(batch_sample['map_index'], dtype=tf.int32))
+        map_state = pfnet_model.layers[-1].cell.map_state(map_state)    # RNN layer
+
         # start trajectory with initial particles and weights
-        state = [init_particles, init_particle_weights, obstacle_map]
+        state = [init_particles, init_particle_weights, map_state]
 
         # if stateful: reset RNN s.t. initial_state is set to initial particles and weights
         # if non-stateful: pass the state explicity every step
@@ -69,10 +69,16 @@ def run_evaluation(params):
             true_states = tf.convert_to_tensor(batch_sample['true_states'], dtype=tf.float32)
             floor_map = tf.convert_to_tensor(batch_sample['floor_map'], dtype=tf.float32)
             obstacle_map = tf.convert_to_tensor(batch_sample['obstacle_map'], dtype=tf.float32)
+            if params.map_bank:
+                # bank of the scene maps, each sample looks up its map by index
+                obstacle_map = (obstacle_map, tf.convert_to_tensor(batch_sample['map_index'], dtype=tf.int32))
             init_particles = tf.convert_to_tensor(batch_sample['init_particles'], dtype=tf.float32)
             init_particle_weights = tf.constant(np.log(1.0/float(num_particles)),
                                         shape=(batch_size, num_particles), dtype=tf.float32)
 
+            # map state (feature field, pre-rotated maps or mip level, if enabled) is built once per map and trajectory
+            obstacle_map = pfnet_model.layers[-1].cell.map_state(obstacle_map)    # RNN layer
+
             # start trajectory with initial particles and weights
             state = [init_particles, init_particle_weights, obstacle_map]
 
@@ -77,6 +77,9 @@ def run_training(params):
     # Adam optimizer.
     optimizer = tf.optimizers.Adam(learning_rate=params.learningrate)
 
+    # compiled training and validation steps
+    train_step, eval_step = pfnet.pfnet_steps(pfnet_model, optimizer, params, pfnet_loss.compute_loss)
+
     # Define metrics
     train_loss = keras.metrics.Mean('train_loss', dtype=tf.float32)
     test_loss = keras.metrics.Mean('test_loss', dtype=tf.float32)
@@ -98,6 +101,9 @@ def run_training(params):
             odometry = tf.convert_to_tensor(batch_sample['odometry'], dtype=tf.float32)
             floor_map = tf.convert_to_tensor(batch_sample['floor_map'], dtype=tf.float32)
             obstacle_map = tf.convert_to_tensor(batch_sample['obstacle_map'], dtype=tf.float32)
+            if params.map_bank:
+                # bank of the scene maps, each sample looks up its map by index
+                obstacle_map = (obstacle_map, tf.convert_to_tensor(batch_sample['map_index'], dtype=tf.int32))
             observation = tf.convert_to_tensor(batch_sample['observation'], dtype=tf.float32)
             true_states = tf.convert_to_tensor(batch_sample['true_states'], dtype=tf.float32)
             init_particles = tf.convert_to_tensor(batch_sample['init_particles'], dtype=tf.float32)
@@ -112,26 +118,8 @@ def run_training(params):
             if params.stateful:
                 pfnet_model.layers[-1].reset_states(state)    # RNN layer
 
-            # run training over trajectory
-            input = [observation, odometry]
-            model_input = (input, state)
-
-            # enable auto-differentiation
-            with tf.GradientTape() as tape:
-                # forward pass
-                output, state = pfnet_model(model_input, training=True)
-
-                # compute loss
-                particle_states, particle_weights = output
-                loss_dict = pfnet_loss.compute_loss(particle_states, particle_weights, true_states, params.map_pixel_in_meters)
-                loss_pred = loss_dict['pred']
-
-            # compute gradients of the trainable variables with respect to the loss
-            gradients = tape.gradient(loss_pred, pfnet_model.trainable_weights)
-            gradients = list(zip(gradients, pfnet_model.trainable_weights))
-
-            # run one step of gradient descent
-            optimizer.apply_gradients(gradients)
+            # run training over trajectory: forward pass, loss and one step of gradient descent
+            loss_pred, _, _ = train_step(observation, odometry, true_states, init_particles, init_particle_weights, obstacle_map)
             train_loss(loss_pred)  # overall trajectory loss
 
         # log epoch training stats
@@ -153,6 +141,9 @@ def run_training(params):
                 odometry = tf.convert_to_tensor(batch_sample['odometry'], dtype=tf.float32)
                 floor_map = tf.convert_to_tensor(batch_sample['floor_map'], dtype=tf.float32)
                 obstacle_map = tf.convert_to_tensor(batch_sample['obstacle_map'], dtype=tf.float32)
+                if params.map_bank:
+                    # bank of the scene maps, each sample looks up its map by index
+                    obstacle_map = (obstacle_map, tf.convert_to_tensor(batch_sample['map_index'], dtype=tf.int32))
                 observation = tf.convert_to_tensor(batch_sample['observation'], dtype=tf.float32)
                 true_states = tf.convert_to_tensor(batch_sample['true_states'], dtype=tf.float32)
                 init_particles = tf.convert_to_tensor(batch_sample['init_particles'], dtype=tf.float32)
@@ -167,18 +158,8 @@ def run_training(params):
                 if params.stateful:
                     pfnet_model.layers[-1].reset_states(state)    # RNN layer
 
-                # run validation over trajectory
-                input = [observation, odometry]
-                model_input = (input, state)
-
-                # forward pass
-                output, state = pfnet_model(model_input, training=False)
-
-                # compute loss
-                particle_states, particle_weights = output
-                loss_dict = pfnet_loss.compute_loss(particle_states, particle_weights, true_states, params.map_pixel_in_meters)
-                loss_pred = loss_dict['pred']
-
+                # run validation over trajectory: forward pass and loss
+                loss_pred, _, _ = eval_step(observation, odometry, true_states, init_particles, init_particle_weights, obstacle_map)
                 test_loss(loss_pred)  # overall trajectory loss
 
             # log epoch validation stats
@@ -32,6 +32,29 @@ def parse_args():
     argparser.add_argument('--transition_std', nargs='*', default=["0.0", "0.0"], help='Standard deviations for transition model. Values: translation std (meters), rotation std (radians)')
     argparser.add_argument('--resample', type=str, default='false', help='Resample particles in Particle Filter. Possible values: true / false.')
     argparser.add_argument('--alpha_resample_ratio', type=float, default=1.0, help='Trade-off parameter for soft-resampling in PF-net. Only effective if resample == true. Assumes values 0.0 < alpha <= 1.0. Alpha equal to 1.0 corresponds to hard-resampling.')
+    argparser.add_argument('--resample_threshold', type=float, default=1.0, help='Each batch element resamples only if its effective sample size is below resample_threshold * num_particles. Only effective if resample == true. Assumes values 0.0 < resample_threshold <= 1.0. Value 1.0 corresponds to resampling at every step.')
+    argparser.add_argument('--resample_scheme', type=str, default='multinomial', help='Scheme to draw particle indices in resampling. Possible values: multinomial / stratified / systematic.')
+    argparser.add_argument('--jit_compile', type=str, default='false', help='Compile the training and evaluation steps with XLA. Possible values: true / false.')
+    argparser.add_argument('--recompute_obs_update', type=str, default='false', help='Training only: recompute the observation update activations during backprop instead of keeping them for every time step. Possible values: true / false.')
+    argparser.add_argument('--particle_chunk_size', type=int, default=0, help='Run the map and joint encoders of the observation update over chunks of this many particles to bound peak memory. 0 processes all particles at once.')
+    argparser.add_argument('--occupancy_prefilter', type=str, default='false', help='Inference only: score only particles in free space of the global map with the observation model, the others get a low likelihood. Possible values: true / false.')
+    argparser.add_argument('--coarse_to_fine', type=str, default='false', help='Inference: score all particles with a cheap coarse head and only the best ones with the full observation model. Training: distill the full model into the coarse head. Possible values: true / false.')
+    argparser.add_argument('--coarse_top', type=int, default=32, help='Number of best particles (by coarse score) re-scored with the full observation model.')
+    argparser.add_argument('--coarse_explore', type=int, default=8, help='Number of random other particles re-scored with the full observation model.')
+    argparser.add_argument('--batched_transform', type=str, default='true', help='Extract local maps of all particles with a single batched gather. Possible values: true / false.')
+    argparser.add_argument('--batched_obs_encoder', type=str, default='false', help='Encode observations of the whole trajectory in one batched call before the recurrent loop. Possible values: true / false.')
+    argparser.add_argument('--map_feature_field', type=str, default='false', help='Inference only: encode the global map once per episode at discretized orientations and look up particle map features. Possible values: true / false.')
+    argparser.add_argument('--map_field_orientations', type=int, default=32, help='Number of discretized orientations of the map feature field.')
+    argparser.add_argument('--rotated_map_cache', type=str, default='false', help='Inference only: rotate the global map once per episode to discretized headings and crop particle local maps from the nearest heading instead of resampling them. Possible values: true / false.')
+    argparser.add_argument('--rotated_map_headings', type=int, default=64, help='Number of discretized headings of the rotated map cache.')
+    argparser.add_argument('--rotated_map_stride', type=int, default=1, help='Over-sampling of the rotated map cache w.r.t. the local maps, local maps are crops with this stride. Higher values quantize particle positions finer at stride^2 memory.')
+    argparser.add_argument('--map_mipmap', type=str, default='false', help='Sample local maps from the average pooled mip level of the global map closest to window_scaler instead of the full resolution map. Map sizes must be multiples of the mip scale. Possible values: true / false.')
+    argparser.add_argument('--map_bank', type=str, default='false', help='Pass the env scene map once with a per-sample map index instead of one map copy per sample. Possible values: true / false.')
+    argparser.add_argument('--kld_adaptive', type=str, default='false', help='Adapt the number of particles at every resample step with KLD-sampling, num_particles is the maximum. Only effective if resample == true. Possible values: true / false.')
+    argparser.add_argument('--kld_min_particles', type=int, default=10, help='Minimum number of particles for KLD-sampling.')
+    argparser.add_argument('--kld_epsilon', type=float, default=0.05, help='KL divergence bound of KLD-sampling.')
+    argparser.add_argument('--kld_delta', type=float, default=0.01, help='KLD-sampling bound holds with probability 1 - kld_delta.')
+    argparser.add_argument('--kld_bin_size', nargs='*', default=["0.5", "0.174533"], help='Pose histogram bin size for KLD-sampling. Values: translation (meters), rotation (radians)')
 
     # training configuration
     argparser.add_argument('--batch_size', type=int, default=24, help='Minibatch size for training.')
@@ -52,9 +75,12 @@ def parse_args():
     # convert multi-input fileds to numpy arrays
     params.transition_std = np.array(params.transition_std, np.float32)
     params.init_particles_std = np.array(params.init_particles_std, np.float32)
+    params.kld_bin_size = np.array(params.kld_bin_size, np.float32)
 
     assert params.trajlen % params.bptt_steps == 0
     assert params.init_particles_distr in ['gaussian', 'uniform']
+    assert 0.0 < params.resample_threshold <= 1.0
+    assert params.resample_scheme in ['multinomial', 'stratified', 'systematic']
     assert params.agent in ['manual', 'pretrained', 'random']
     assert params.mode in ['headless', 'gui']
 
@@ -69,6 +95,8 @@ def parse_args():
 
     # params.transition_std = np.array(params.transition_std[0] / params.map_pixel_in_meters, params.transition_std[1])   # in pixels & radians
 
+    params.kld_bin_size[0] = params.kld_bin_size[0] / params.map_pixel_in_meters  # convert meters to pixels
+
     # fix seed
     np.random.seed(params.seed)
     tf.random.set_seed(params.seed)
@@ -85,10 +113,37 @@ def parse_args():
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
     # convert boolean fields
-    if params.resample not in ['false', 'true']:
-        raise ValurError
-    else:
-        params.resample = (params.resample == 'true')
+    for field in ['resample', 'batched_transform', 'batched_obs_encoder', 'map_feature_field', 'rotated_map_cache', 'map_mipmap', 'map_bank', 'kld_adaptive', 'jit_compile', 'recompute_obs_update', 'occupancy_prefilter', 'coarse_to_fine']:
+        if getattr(params, field) not in ['false', 'true']:
+            raise ValueError
+        setattr(params, field, getattr(params, field) == 'true')
+
+    # kld adaptive mode observes a data dependent number of particles, which XLA can not compile
+    if params.jit_compile and params.kld_adaptive:
+        raise ValueError('jit_compile requires a fixed number of particles, disable kld_adaptive')
+    # chunked, pre-filtered and coarse-to-fine observation updates assume a fixed number of particles
+    if params.kld_adaptive and (params.particle_chunk_size or params.occupancy_prefilter or params.coarse_to_fine):
+        raise ValueError('particle_chunk_size, occupancy_prefilter and coarse_to_fine require a fixed number of particles, disable kld_adaptive')
+
+    # occupancy pre-filter looks up the raw global map
+    if params.map_feature_field and params.occupancy_prefilter:
+        raise ValueError('occupancy_prefilter requires the global map, disable map_feature_field')
+    if params.map_feature_field and params.coarse_to_fine:
+        raise ValueError('coarse_to_fine requires the global map, disable map_feature_field')
+
+    # rotated map cache replaces the global map in the recurrent state
+    if params.rotated_map_cache and params.map_feature_field:
+        raise ValueError('rotated_map_cache and map_feature_field are exclusive')
+    if params.rotated_map_cache and (params.occupancy_prefilter or params.coarse_to_fine):
+        raise ValueError('occupancy_prefilter and coarse_to_fine require the global map, disable rotated_map_cache')
+
+    # mip level replaces the global map in the recurrent state
+    if params.map_mipmap and (params.map_feature_field or params.rotated_map_cache):
+        raise ValueError('map_feature_field and rotated_map_cache are built from the global map, disable map_mipmap')
+    if params.map_mipmap and params.occupancy_prefilter:
+        raise ValueError('occupancy_prefilter requires the global map, disable map_mipmap')
+    # all trajectories of a batch are recorded in the env scene, the bank holds its map only
+    params.map_bank_size = 1
 
     gpus = tf.config.experimental.list_physical_devices('GPU')
     assert params.gpu_num < len(gpus)
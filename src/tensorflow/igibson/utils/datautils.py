@@ -404,8 +404,17 @@ def transform_raw_record(env, parsed_record, params):
                 [batch_size] + list(parsed_record['state_shape'][0]))[:, :trajlen]
 
     # get floor and obstance map of environment scene
-    trans_record['obstacle_map'] = tf.tile(tf.expand_dims(env.get_obstacle_map(), axis=0), [batch_size, 1, 1, 1])
-    trans_record['floor_map'] = tf.tile(tf.expand_dims(env.get_floor_map(), axis=0), [batch_size, 1, 1, 1])
+    if params.map_bank:
+        # all trajectories are recorded in the env scene, the map bank holds its map once
+        map_bank_size = 1
+        trans_record['obstacle_map'] = tf.expand_dims(env.get_obstacle_map(), axis=0)
+        trans_record['floor_map'] = tf.expand_dims(env.get_floor_map(), axis=0)
+        trans_record['map_index'] = np.zeros(batch_size, np.int32)
+    else:
+        map_bank_size = batch_size
+        trans_record['obstacle_map'] = tf.tile(tf.expand_dims(env.get_obstacle_map(), axis=0), [batch_size, 1, 1, 1])
+        trans_record['floor_map'] = tf.tile(tf.expand_dims(env.get_floor_map(), axis=0), [batch_size, 1, 1, 1])
+        trans_record['map_index'] = np.arange(batch_size, dtype=np.int32)
 
     # sample random particles and corresponding weights
     trans_record['init_particles'] = env.get_random_particles(num_particles, particles_distr, trans_record['true_states'][:, 0, :], particles_cov)
@@ -415,7 +424,7 @@ def transform_raw_record(env, parsed_record, params):
     assert list(trans_record['true_states'].shape) == [batch_size, trajlen, 3]
     assert list(trans_record['observation'].shape) == [batch_size, trajlen, 56, 56, 3]
     assert list(trans_record['init_particles'].shape) == [batch_size, num_particles, 3]
-    assert list(trans_record['floor_map'].shape) == [batch_size, map_size[0], map_size[1], map_size[2]]
-    assert list(trans_record['obstacle_map'].shape) == [batch_size, map_size[0], map_size[1], map_size[2]]
+    assert list(trans_record['floor_map'].shape) == [map_bank_size, map_size[0], map_size[1], map_size[2]]
+    assert list(trans_record['obstacle_map'].shape) == [map_bank_size, map_size[0], map_size[1], map_size[2]]
 
     return trans_record
@@ -39,6 +39,9 @@ class LocalizeGibsonEnv(iGibsonEnv):
             self.pfnet_model.load_weights(self.params.pfnet_load)
             print("=====> Loaded pf model from " + params.pfnet_load)
 
+        # single step particle filter sharing the cell (and weights) of the pf model
+        self.localizer = pfnet.Localizer(self.params, self.pfnet_model.layers[-1].cell)    # RNN layer
+
         super(LocalizeGibsonEnv, self).__init__(config_file=self.params.config_filename,
                         scene_id=None,
                         mode=self.params.mode,
@@ -119,7 +122,6 @@ class LocalizeGibsonEnv(iGibsonEnv):
 
         old_obs = self.robot_obs
         floor_map = self.floor_map[0]
-        old_pfnet_state = self.pfnet_state
         old_pose = self.robot_pose[0].numpy()
 
         # perform env step
@@ -148,28 +150,16 @@ class LocalizeGibsonEnv(iGibsonEnv):
                         tf.convert_to_tensor(new_pose, dtype=tf.float32)
                         , axis=0)
 
-        odometry = tf.expand_dims(odom, axis=1)
-        observation = tf.expand_dims(old_obs, axis=1)
-
         # sanity check
-        assert list(odometry.shape) == [batch_size, trajlen, 3]
-        assert list(observation.shape) == [batch_size, trajlen, 56, 56, 3]
-        assert list(old_pfnet_state[0].shape) == [batch_size, num_particles, 3]
-        assert list(old_pfnet_state[1].shape) == [batch_size, num_particles]
-
-        input = [observation, odometry]
-        model_input = (input, old_pfnet_state)
+        assert list(odom.shape) == [batch_size, 3]
+        assert list(old_obs.shape) == [batch_size, 56, 56, 3]
 
-        # if stateful: reset RNN s.t. initial_state is set to initial particles and weights
-        # if non-stateful: pass the state explicity every step
-        if self.params.stateful:
-            self.pfnet_model.layers[-1].reset_states(old_pfnet_state)    # RNN layer
-
-        # forward pass
-        output, new_pfnet_state = self.pfnet_model(model_input, training=False)
+        # single particle filter step, self.pfnet_state refers to the localizer variables which are updated in place
+        particles, particle_weights = self.localizer.update(old_obs, odom)   # before transition update
+        particles = tf.expand_dims(particles, axis=1)
+        particle_weights = tf.expand_dims(particle_weights, axis=1)
 
         # compute loss
-        particles, particle_weights = output # before transition update
         true_pose = tf.expand_dims(self.robot_pose, axis=1)
 
         assert list(true_pose.shape) == [batch_size, trajlen, 3]
@@ -179,7 +169,6 @@ class LocalizeGibsonEnv(iGibsonEnv):
 
         reward = reward - tf.squeeze(loss_dict['coords']).numpy() #
 
-        self.pfnet_state = new_pfnet_state
         self.robot_pose = new_pose
         self.robot_obs = new_obs
 
@@ -262,7 +251,10 @@ class LocalizeGibsonEnv(iGibsonEnv):
         assert list(floor_map.shape) == [batch_size, map_size[0], map_size[1], map_size[2]]
         assert list(obstacle_map.shape) == [batch_size, map_size[0], map_size[1], map_size[2]]
 
-        self.pfnet_state = [init_particles, init_particle_weights, obstacle_map]
+        # precomputed map feature field, if enabled, is encoded once per episode
+        self.localizer.reset(obstacle_map, init_particles, init_particle_weights)
+
+        self.pfnet_state = [self.localizer.particle_states, self.localizer.particle_weights, self.localizer.map_state]
         self.obstacle_map = obstacle_map
         self.floor_map = floor_map
         self.robot_pose = true_pose
@@ -71,7 +71,7 @@ def display_results(params):
     testfiles = params.testfiles
 
     # evaluation data
-    test_ds = datautils.get_dataflow(testfiles, batch_size, is_training=True)
+    test_ds = datautils.get_dataflow(testfiles, batch_size, is_training=True, map_size_buckets=params.map_size_buckets)
 
     # pf model
     model = pfnet.pfnet_model(params)
@@ -99,14 +99,22 @@ def display_results(params):
         observations = tf.convert_to_tensor(data_sample['observation'], dtype=tf.float32)
         odometry = tf.convert_to_tensor(data_sample['odometry'], dtype=tf.float32)
         true_states = tf.convert_to_tensor(data_sample['true_states'], dtype=tf.float32)
-        global_map = tf.convert_to_tensor(data_sample['global_map'], dtype=tf.float32)
+        global_map = datautils.map_to_tensor(data_sample['global_map'])
         global_map_shape = data_sample['org_map_shapes']
+        map_index = data_sample['map_index']
         init_particles = tf.convert_to_tensor(data_sample['init_particles'], dtype=tf.float32)
         init_particle_weights = tf.constant(np.log(1.0/float(num_particles)),
                                     shape=(batch_size, num_particles), dtype=tf.float32)
 
+        # map state (feature field, pre-rotated maps or mip level, if enabled) is built once per map and trajectory
+        map_state = global_map
+        if params.map_bank:
+            # bank of the unique maps of the batch, each sample looks up its map by index
+            map_state = (global_map, tf.convert_to_tensor(map_index, dtype=tf.int32))
+        map_state = model.layers[-1].cell.map_state(map_state)    # RNN layer
+
         # start trajectory with initial particles and weights
-        state = [init_particles, init_particle_weights, global_map]
+        state = [init_particles, init_particle_weights, map_state]
 
         # if stateful: reset RNN s.t. initial_state is set to initial particles and weights
         # if non-stateful: pass the state explicity every step
@@ -137,7 +145,7 @@ def display_results(params):
                         ), axis=2)
 
         # plot map
-        map = global_map[0, :global_map_shape[0][0], :global_map_shape[0][1], 0].numpy()
+        map = global_map[map_index[0], :global_map_shape[0][0], :global_map_shape[0][1], 0].numpy()
         map_plt = draw_map(plt_ax, map)
 
         images = []
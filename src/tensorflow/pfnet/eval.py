@@ -2,6 +2,7 @@
 
 import sys
 import pfnet
+import itertools
 import numpy as np
 from tqdm import tqdm
 import tensorflow as tf
@@ -24,8 +25,10 @@ def run_evaluation(params):
     trajlen = params.trajlen
     num_batches = dataset_size() // batch_size
 
-    # evaluation data
-    test_ds = datautils.get_dataflow(params.testfiles, params.batch_size, is_training=False)
+    # evaluation data, not grouped by scene s.t. no records are dropped, the map bank must hold the scenes of any batch
+    if params.map_bank and params.map_bank_size < params.batch_size:
+        raise ValueError('evaluation batches mix scenes, map_bank requires map_bank_size == batch_size')
+    test_ds = datautils.get_dataflow(params.testfiles, params.batch_size, is_training=False, map_size_buckets=params.map_size_buckets)
 
     # pf model
     model = pfnet.pfnet_model(params)
@@ -40,19 +43,24 @@ def run_evaluation(params):
         mse_list = []
         success_list = []
         itr = test_ds.as_numpy_iterator()
-        # run evaluation over all evaluation samples in an epoch
-        for idx in tqdm(range(num_batches)):
-            raw_record = next(itr)
+        # run evaluation over all evaluation samples in an epoch, can end earlier if maps are bucketed by size
+        for raw_record in tqdm(itertools.islice(itr, num_batches), total=num_batches):
             data_sample = datautils.transform_raw_record(raw_record, params)
 
             observations = tf.convert_to_tensor(data_sample['observation'], dtype=tf.float32)
             odometry = tf.convert_to_tensor(data_sample['odometry'], dtype=tf.float32)
             true_states = tf.convert_to_tensor(data_sample['true_states'], dtype=tf.float32)
-            global_map = tf.convert_to_tensor(data_sample['global_map'], dtype=tf.float32)
+            global_map = datautils.map_to_tensor(data_sample['global_map'])
+            if params.map_bank:
+                # bank of the unique maps of the batch, each sample looks up its map by index
+                global_map = (global_map, tf.convert_to_tensor(data_sample['map_index'], dtype=tf.int32))
             init_particles = tf.convert_to_tensor(data_sample['init_particles'], dtype=tf.float32)
             init_particle_weights = tf.constant(np.log(1.0/float(num_particles)),
                                         shape=(batch_size, num_particles), dtype=tf.float32)
 
+            # map state (feature field, pre-rotated maps or mip level, if enabled) is built once per map and trajectory
+            global_map = model.layers[-1].cell.map_state(global_map)    # RNN layer
+
             # start trajectory with initial particles and weights
             state = [init_particles, init_particle_weights, global_map]
 
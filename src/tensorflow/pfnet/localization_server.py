@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import time
+import queue
+import pfnet
+import numpy as np
+
+class LocalizationServer(object):
+    """
+    Serves the particle filters of many clients (robots/envs) with a single pf model
+    Update requests of different clients are batched dynamically into one PFCell step,
+    each client owns a slot of the batched particle state
+
+    Requests are tuples put on the request queue, queue.Queue in process or multiprocessing.Manager().Queue()
+    across processes (reply queues are sent along with the requests and must be picklable):
+        ('reset', client_id, reply_queue, global_map, init_particles)
+        ('update', client_id, reply_queue, observation, odometry)
+        ('close', client_id, reply_queue)
+    A request that fails is answered with the exception instead of the result, the server keeps serving
+    """
+    def __init__(self, params, request_queue, cell=None, max_latency=0.01):
+        """
+        :param params: parsed arguments, params.batch_size is the number of slots
+        :param request_queue: queue the clients put their requests on
+        :param cell: PFCell to run, e.g. the cell of a pfnet_model() with loaded weights (optional)
+        :param max_latency: max. time (seconds) the first pending update waits for other clients to join the batch
+        """
+        assert None not in params.global_map_size, 'slots share a fixed map size'
+        assert not getattr(params, 'map_bank', False), 'slots reset their own global map'
+
+        self.params = params
+        self.num_slots = params.batch_size
+        self.request_queue = request_queue
+        self.max_latency = max_latency
+        self.localizer = pfnet.Localizer(params, cell)
+
+        # slot table: client_id -> slot, slots are reused after close
+        self.slots = {}
+        self.free_slots = list(range(self.num_slots))
+
+        # allocate the batched particle state of all slots
+        num_particles = params.num_particles
+        self.localizer.reset(
+                np.zeros((self.num_slots, *params.global_map_size), np.float32),
+                np.zeros((self.num_slots, num_particles, 3), np.float32)
+        )
+
+        # preallocated step inputs
+        self.observation = np.zeros((self.num_slots, 56, 56, 3), np.float32)
+        self.odometry = np.zeros((self.num_slots, 3), np.float32)
+
+    def serve_forever(self):
+        """
+        Processes requests until a None request is received
+        """
+        while self.process_requests():
+            pass
+
+    def process_requests(self, timeout=None):
+        """
+        Processes requests until a batch of updates has run
+        The batch runs once every client with a slot has a pending update or when max_latency is exceeded
+        :param timeout: max. time (seconds) to wait for the first request, None blocks
+        :return bool: False if a None (stop) request was received or timeout expired, else True
+        """
+        pending = {}    # slot -> (client_id, reply_queue, observation, odometry)
+        deadline = None
+
+        while True:
+            if deadline is None:
+                wait = timeout
+            else:
+                wait = max(deadline - time.time(), 0.0)
+
+            try:
+                request = self.request_queue.get(timeout=wait)
+            except queue.Empty:
+                if deadline is None:
+                    return False
+                break   # max. latency exceeded, run the pending updates
+
+            if request is None:
+                self.run_updates(pending)
+                return False
+
+            action, client_id, reply_queue = request[:3]
+            try:
+                if action == 'reset':
+                    reply_queue.put(self.reset_client(client_id, *request[3:]))
+                elif action == 'close':
+                    reply_queue.put(self.close_client(client_id))
+                elif action == 'update':
+                    if client_id not in self.slots:
+                        raise KeyError(f'unknown client {client_id}, reset it first')
+                    slot = self.slots[client_id]
+                    if slot in pending:
+                        # second update of the same client, run the batch first
+                        self.run_updates(pending)
+                        pending = {}
+                    pending[slot] = (client_id, reply_queue, *request[3:])
+                    if deadline is None:
+                        deadline = time.time() + self.max_latency
+                else:
+                    raise ValueError(f'unknown action {action}')
+            except Exception as error:
+                # reply with the error, the client raises it
+                reply_queue.put(error)
+
+            if pending and len(pending) == len(self.slots):
+                break   # every client is waiting for its update
+
+        self.run_updates(pending)
+        return True
+
+    def reset_client(self, client_id, global_map, init_particles):
+        """
+        Assigns a slot to the client (if not done yet) and starts a new episode in it
+        :param client_id: hashable id of the client
+        :param global_map: global map (H, W, 1) of size params.global_map_size
+        :param init_particles: initial particle states (k, 3)
+        :return int: slot of the client
+        """
+        new_client = client_id not in self.slots
+        if new_client:
+            if not self.free_slots:
+                raise RuntimeError(f'no free slot for client {client_id}, increase batch_size')
+            self.slots[client_id] = self.free_slots.pop(0)
+
+        slot = self.slots[client_id]
+        try:
+            self.localizer.reset_element(slot, global_map, init_particles)
+        except Exception:
+            if new_client:
+                # e.g. map of the wrong size, release the slot again
+                self.close_client(client_id)
+            raise
+        return slot
+
+    def close_client(self, client_id):
+        """
+        Releases the slot of the client
+        :param client_id: hashable id of the client
+        :return int: released slot
+        """
+        if client_id not in self.slots:
+            raise KeyError(f'unknown client {client_id}')
+        slot = self.slots.pop(client_id)
+        self.free_slots.append(slot)
+        return slot
+
+    def run_updates(self, pending):
+        """
+        Runs one batched particle filter step for the pending updates and replies to the clients
+        :param pending: dict slot -> (client_id, reply_queue, observation (56, 56, 3), odometry (3, ))
+        """
+        if not pending:
+            return
+
+        active = np.zeros(self.num_slots, bool)
+        for slot, (_, reply_queue, observation, odometry) in list(pending.items()):
+            try:
+                self.observation[slot] = observation
+                self.odometry[slot] = odometry
+            except Exception as error:
+                # e.g. observation of the wrong shape, only this client fails
+                reply_queue.put(error)
+                del pending[slot]
+                continue
+            active[slot] = True
+
+        if not pending:
+            return
+        try:
+            particles, particle_weights = self.localizer.update(self.observation, self.odometry, active)
+            est_pose = self.localizer.estimate().numpy()
+            particles = particles.numpy()
+            particle_weights = particle_weights.numpy()
+        except Exception as error:
+            for _, reply_queue, _, _ in pending.values():
+                reply_queue.put(error)
+            return
+
+        for slot, (_, reply_queue, _, _) in pending.items():
+            # pose estimate after the transition update, particle set before
+            reply_queue.put((est_pose[slot], particles[slot], particle_weights[slot]))
+
+class LocalizationClient(object):
+    """
+    Client side of LocalizationServer, each call blocks until the server replies
+    and raises the error of a failed request
+    """
+    def __init__(self, client_id, request_queue, reply_queue=None, timeout=60.0):
+        """
+        :param client_id: hashable id of the client, unique per server
+        :param request_queue: request queue of the server
+        :param reply_queue: queue the server replies on, in process queue.Queue by default,
+            multiprocessing.Manager().Queue() if the server runs in another process
+        :param timeout: max. time (seconds) to wait for a reply, None blocks
+            the first update of a server includes tracing the pf step
+        """
+        self.client_id = client_id
+        self.request_queue = request_queue
+        self.reply_queue = queue.Queue() if reply_queue is None else reply_queue
+        self.timeout = timeout
+
+    def reply(self):
+        """
+        :return: reply of the server to the last request
+        """
+        try:
+            reply = self.reply_queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f'no reply from the localization server within {self.timeout}s')
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def reset(self, global_map, init_particles):
+        """
+        :param global_map: global map (H, W, 1)
+        :param init_particles: initial particle states (k, 3)
+        :return int: slot of the client
+        """
+        self.request_queue.put(('reset', self.client_id, self.reply_queue, global_map, init_particles))
+        return self.reply()
+
+    def update(self, observation, odometry):
+        """
+        :param observation: image observation at time t (56, 56, ch)
+        :param odometry: relative motion from time t to t+1 (3, )
+        :return (3, ) (k, 3) (k, ): estimated pose, particle states and weights after the observation update
+        """
+        self.request_queue.put(('update', self.client_id, self.reply_queue, observation, odometry))
+        return self.reply()
+
+    def close(self):
+        self.request_queue.put(('close', self.client_id, self.reply_queue))
+        return self.reply()
+
+if __name__ == '__main__':
+    # in process demo: several clients served by one server thread
+    import argparse
+    import threading
+
+    params = argparse.Namespace(
+        batch_size=4, num_particles=30, global_map_size=(100, 100, 1), window_scaler=8.0,
+        transition_std=np.array([0.0, 0.0]), map_pixel_in_meters=0.02,
+        resample=False, alpha_resample_ratio=1.0,
+    )
+
+    request_queue = queue.Queue()
+    server = LocalizationServer(params, request_queue)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+
+    def run_client(client_id):
+        client = LocalizationClient(client_id, request_queue)
+        client.reset(np.ones(params.global_map_size, np.float32), np.random.uniform(20, 80, (params.num_particles, 3)))
+        for _ in range(5):
+            est_pose, _, _ = client.update(np.random.uniform(size=(56, 56, 3)), np.zeros(3))
+        print(f'client {client_id}: {est_pose}')
+        client.close()
+
+    client_threads = [threading.Thread(target=run_client, args=(idx, )) for idx in range(3)]
+    for thread in client_threads:
+        thread.start()
+    for thread in client_threads:
+        thread.join()
+
+    request_queue.put(None)
+    server_thread.join()
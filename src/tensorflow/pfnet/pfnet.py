@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import numpy as np
+from statistics import NormalDist
 import tensorflow as tf
 from utils import networks
 from tensorflow import keras
-from utils.spatial_transformer import transformer
+from utils.spatial_transformer import transformer, batch_transformer
+
+# log weight of padded (inactive) particles in kld adaptive mode, finite s.t. gradients stay NaN free
+INACTIVE_LOG_WEIGHT = -1e9
+
+# occupancy pre-filter: global map values above are free space, particles elsewhere score this margin
+# below the least likely valid particle of their batch element (the likelihood head is unbounded)
+FREE_SPACE_MAP_VALUE = 1.0
+INVALID_LOG_LIKELIHOOD_MARGIN = 10.0
 
 class PFCell(keras.layers.AbstractRNNCell):
     """
@@ -27,19 +37,104 @@ class PFCell(keras.layers.AbstractRNNCell):
         self.map_shape = (self.params.batch_size, *self.params.global_map_size)
         super(PFCell, self).__init__(**kwargs)
 
+        # optional modes, not every caller's params define them
+        self.batched_transform = getattr(self.params, 'batched_transform', True)
+        self.batched_obs_encoder = getattr(self.params, 'batched_obs_encoder', False)
+        self.map_feature_field = getattr(self.params, 'map_feature_field', False)
+        self.map_field_orientations = getattr(self.params, 'map_field_orientations', 32)
+        self.rotated_map_cache = getattr(self.params, 'rotated_map_cache', False)
+        self.rotated_map_headings = getattr(self.params, 'rotated_map_headings', 64)
+        self.rotated_map_stride = getattr(self.params, 'rotated_map_stride', 1)
+        self.map_mipmap = getattr(self.params, 'map_mipmap', False)
+        self.map_bank = getattr(self.params, 'map_bank', False)
+        self.map_bank_size = getattr(self.params, 'map_bank_size', 1)
+        self.map_feature_cache_enabled = getattr(self.params, 'map_feature_cache', False)
+        self.kld_adaptive = getattr(self.params, 'kld_adaptive', False)
+        self.resample_threshold = getattr(self.params, 'resample_threshold', 1.0)
+        self.resample_scheme = getattr(self.params, 'resample_scheme', 'multinomial')
+        self.particle_chunk_size = getattr(self.params, 'particle_chunk_size', 0)
+        self.occupancy_prefilter = getattr(self.params, 'occupancy_prefilter', False)
+        self.coarse_to_fine = getattr(self.params, 'coarse_to_fine', False)
+
+        # counter-based generator that seeds stateless random ops, keeps the pf step compilable with XLA
+        self.rng = tf.random.Generator.from_seed(getattr(self.params, 'seed', 42))
+
+        # optionally recompute the observation update activations (local maps, map and tiled observation features)
+        # during backprop instead of holding them on the tape for every time step
+        if getattr(self.params, 'recompute_obs_update', False):
+            self.observation_update_fn = tf.recompute_grad(self.observation_update)
+        else:
+            self.observation_update_fn = self.observation_update
+
+        # global map pixels per map state pixel, local maps are sampled from the mip level closest to window_scaler
+        self.mip_scale = 1
+        if self.map_mipmap:
+            self.mip_scale = 2 ** int(np.floor(np.log2(self.params.window_scaler)))
+
+        if self.kld_adaptive:
+            # num_particles is the maximum, particle count adapts at every resample step
+            if not self.batched_transform:
+                raise ValueError('kld_adaptive requires batched_transform')
+            if self.particle_chunk_size or self.occupancy_prefilter or self.coarse_to_fine:
+                raise ValueError('particle_chunk_size, occupancy_prefilter and coarse_to_fine require a fixed number of particles')
+            self.kld_min_particles = min(self.params.kld_min_particles, self.params.num_particles)
+            self.kld_z = NormalDist().inv_cdf(1.0 - self.params.kld_delta)
+
+        if self.map_bank and not self.batched_transform:
+            raise ValueError('map_bank requires batched_transform')
+        if self.map_feature_cache_enabled and not self.batched_transform:
+            raise ValueError('map_feature_cache requires batched_transform')
+
         # models
         self.obs_model = networks.obs_encoder()
         self.map_model = networks.map_encoder()
         self.joint_matrix_model = networks.map_obs_encoder()
         self.joint_vector_model = networks.likelihood_estimator()
 
+        map_feature_cache = None
+        if self.map_feature_cache_enabled:
+            # map features of recently seen (map, quantized pose) keys, see cached_map_features()
+            self.map_cache_grid = tuple(float(size) for size in self.params.map_cache_grid)
+            map_feature_cache = MapFeatureCache(self.params.map_cache_size, self.map_model.output_shape[1:])
+        # runtime state, kept out of the layer weights and checkpoints
+        self._setattr_tracking = False
+        self.map_feature_cache = map_feature_cache
+        self._setattr_tracking = True
+
+        if self.coarse_to_fine:
+            # cheap scoring head, trained by distillation from the full model, see coarse_distillation_loss()
+            self.coarse_map_model = networks.coarse_map_encoder()
+            self.coarse_obs_model = networks.coarse_obs_encoder()
+
+        if self.map_feature_field:
+            # recurrent state carries the precomputed map feature field instead of the global map
+            self.map_field_model = networks.map_field_encoder(self.map_model)
+            field_size = self.map_field_image_size() // 2
+            self.map_shape = (self.params.batch_size, self.map_field_orientations,
+                                field_size, field_size, self.map_model.output_shape[-1])
+        elif self.rotated_map_cache:
+            # recurrent state carries the pre-rotated global maps instead of the global map
+            image_size = self.map_field_image_size() * self.rotated_map_stride
+            self.map_shape = (self.params.batch_size, self.rotated_map_headings,
+                                image_size, image_size, self.params.global_map_size[-1])
+        elif self.map_mipmap:
+            # recurrent state carries the mip level of the global map
+            global_height, global_width, channels = self.params.global_map_size
+            self.map_shape = (self.params.batch_size,
+                                None if global_height is None else global_height // self.mip_scale,
+                                None if global_width is None else global_width // self.mip_scale, channels)
+
+        if self.map_bank:
+            # map state of map_bank_size unique maps, the recurrent state carries a per-sample index into it
+            self.map_shape = (self.map_bank_size, *self.map_shape[1:])
+
     @property
     def state_size(self):
         """
         Size(s) of state(s) used by this cell
-        :return tuple(TensorShapes): shape of particle_states, particle_weights
+        :return tuple(TensorShapes): shape of particle_states, particle_weights, global_map (or map index)
         """
-        return [tf.TensorShape(self.states_shape[1:]), tf.TensorShape(self.weights_shape[1:]), tf.TensorShape(self.map_shape[1:])]
+        return [tf.TensorShape(self.states_shape[1:]), tf.TensorShape(self.weights_shape[1:]), self.map_state_size()]
 
     @property
     def output_size(self):
@@ -47,37 +142,76 @@ class PFCell(keras.layers.AbstractRNNCell):
         Size(s) of output(s) produced by this cell
         :return tuple(TensorShapes): shape of particle_states, particle_weights
         """
-        return [tf.TensorShape(self.states_shape[1:]), tf.TensorShape(self.weights_shape[1:]), tf.TensorShape(self.map_shape[1:])]
+        return [tf.TensorShape(self.states_shape[1:]), tf.TensorShape(self.weights_shape[1:]), self.map_state_size()]
+
+    def map_state_size(self):
+        if self.map_bank:
+            # per-sample map index
+            return tf.TensorShape([])
+        return tf.TensorShape(self.map_shape[1:])
 
-    def call(self, input, state):
+    def call(self, input, state, training=None, constants=None):
         """
         Implements a particle update
         :param input: observation (batch, 56, 56, ch), odometry (batch, 3), global_map (batch, H, W, 1)
             observation is the sensor reading at time t,
+                or its encoded features (batch, 14, 14, 16) if batched_obs_encoder is enabled
             odometry is the relative motion from time t to t+1,
             global map of environment
         :param state: particle_states (batch, k, 3), particle_weights (batch, k)
             weights are assumed to be in log space and unnormalized
+            the global map is replaced by the per-sample map index (batch, ) if map_bank is enabled
+        :param training: coarse-to-fine scoring, the occupancy pre-filter and the map feature cache,
+            if enabled, are used for inference only
+        :param constants: map bank (m, H, W, 1) if map_bank is enabled
         :return output: particle_states and particle_weights after the observation update.
             (but before the transition update)
         :return state: updated particle_states and particle_weights.
             (but after both observation and transition updates)
         """
-        particle_states, particle_weights, global_map = state
+        particle_states, particle_weights, map_state = state
         observation, odometry = input
 
+        global_map = map_state
+        if self.map_bank:
+            # unique maps are an RNN constant, each sample looks up its map by index
+            global_map = (constants[0], map_state)
+
+        observation_update = self.observation_update_fn
+        if not training and (self.coarse_to_fine or self.occupancy_prefilter or self.map_feature_cache is not None):
+            observation_update = functools.partial(self.observation_update,
+                                    coarse_to_fine=self.coarse_to_fine, prefilter=self.occupancy_prefilter,
+                                    map_cache=self.map_feature_cache is not None)
+
         # observation update
-        lik = self.observation_update(
-                    global_map, particle_states, observation
-        )
+        if self.kld_adaptive:
+            # observe the active particles only, padded particles keep INACTIVE_LOG_WEIGHT
+            num_particles = particle_states.shape.as_list()[1]
+            num_active = tf.reduce_max(tf.reduce_sum(tf.cast(self.active_particles(particle_weights), tf.int32), axis=-1))
+            lik = observation_update(
+                        global_map, particle_states[:, :num_active], observation
+            )
+            lik = tf.pad(lik, [[0, 0], [0, num_particles - num_active]])
+            lik = tf.reshape(lik, particle_weights.shape)
+        else:
+            lik = observation_update(
+                        global_map, particle_states, observation
+            )
         particle_weights = particle_weights + lik # unnormalized
 
         # resample
         if self.params.resample:
-            particle_states, particle_weights = self.resample(
+            new_particle_states, new_particle_weights = self.resample(
                     particle_states, particle_weights,
                     alpha=self.params.alpha_resample_ratio
             )
+            if self.resample_threshold < 1.0:
+                # resample selectively per batch element based on its effective sample size, without host sync
+                resample_mask = self.resample_mask(particle_weights)   # (bs, )
+                particle_states = tf.where(resample_mask[:, None, None], new_particle_states, particle_states)
+                particle_weights = tf.where(resample_mask[:, None], new_particle_weights, particle_weights)
+            else:
+                particle_states, particle_weights = new_particle_states, new_particle_weights
 
         # construct output before motion update
         output = [particle_states, particle_weights]
@@ -86,58 +220,642 @@ class PFCell(keras.layers.AbstractRNNCell):
         particle_states = self.transition_model(particle_states, odometry)
 
         # construct new state after motion update
-        state = [particle_states, particle_weights, global_map]
+        state = [particle_states, particle_weights, map_state]
 
         return output, state
 
-    def observation_update(self, global_map, particle_states, observation):
+    def encode_observations(self, observations):
+        """
+        Encodes the observations of all time steps in one batched call of the observation model
+        :param observations: image observations (batch, T, 56, 56, ch)
+        :return (batch, T, 14, 14, 16): observation features
+        """
+
+        batch_size, trajlen = observations.shape.as_list()[:2]
+
+        # flatten batch and time dimensions
+        observations = tf.reshape(observations,
+                [batch_size * trajlen] + observations.shape.as_list()[2:])
+        obs_features = self.obs_model(observations)
+
+        return tf.reshape(obs_features,
+                [batch_size, trajlen] + obs_features.shape.as_list()[1:])
+
+    def map_state(self, global_map):
+        """
+        Map entry of the recurrent state for the given global map
+        :param global_map: global map input (batch, H, W, 1)
+            or the pair (map bank (m, H, W, 1), map index (batch, )) if map_bank is enabled
+        :return: global map itself, or its feature field (batch, n, F, F, 8) if map_feature_field is enabled,
+            or the pre-rotated global maps (batch, n, N, N, 1) if rotated_map_cache is enabled
+            or its mip level (batch, H / s, W / s, 1) if map_mipmap is enabled
+            paired with the map index if map_bank is enabled, built once per unique map
+        """
+        images, map_index = self.split_map(global_map)
+        if map_index is None:
+            return self.map_images_state(images)
+        return self.map_images_state(images), map_index
+
+    def map_images_state(self, images):
+        """
+        :param images: global maps (batch or m, H, W, 1)
+        :return: map state of each global map, see map_state()
+        """
+        if self.map_feature_cache is not None:
+            # new maps, cached map features are keyed by batch or bank index
+            self.map_feature_cache.clear()
+
+        if self.map_feature_field:
+            return self.encode_map_field(images)
+        if self.rotated_map_cache:
+            return self.rotate_global_maps(images, self.rotated_map_headings, self.rotated_map_stride)
+        if self.map_mipmap:
+            return self.mip_level(images)
+        return images
+
+    def split_map(self, global_map):
+        """
+        :param global_map: global map input, map feature field, ... (batch, ...)
+            or the pair (map images (m, ...), map index (batch, )), e.g. the map bank if map_bank is enabled
+        :return: map images (batch or m, ...) and the per-sample image index (batch, ), None if images are per-sample
+        """
+        if isinstance(global_map, (tuple, list)):
+            map_images, map_index = global_map
+            return map_images, map_index
+        return global_map, None
+
+    def mip_level(self, global_map):
+        """
+        Mip level of the global map the local maps are sampled from: the global map box filtered
+        and down-sampled by mip_scale, i.e. one level pixel per local map pixel at window_scaler
+        Equivalent to mip_scale / 2 successive 2x2 average poolings of the mip pyramid
+        :param global_map: global map input (batch, H, W, ch), H and W multiples of mip_scale
+        :return (batch, H / mip_scale, W / mip_scale, ch): mip level
+        """
+        if self.mip_scale == 1:
+            return global_map
+        return tf.nn.avg_pool2d(global_map, ksize=self.mip_scale, strides=self.mip_scale, padding='VALID')
+
+    def map_field_image_size(self):
+        """
+        Size of the rotated and down-scaled global map images the map feature field (or rotated map cache) is built from
+        :return int: (even) side of the square image, large enough to hold the global map at any orientation
+        """
+        global_height, global_width = self.params.global_map_size[:2]
+        local_size = 28
+
+        image_size = int(np.ceil(np.sqrt(global_height**2 + global_width**2) / self.params.window_scaler)) + 2 * local_size
+        return image_size + image_size % 2
+
+    def rotate_global_maps(self, global_map, num_orientations, stride=1):
+        """
+        Rotates the global map to n discretized orientations and down-scales it like the local maps,
+        i.e. one image pixel is one local map pixel (or 1 / stride of it)
+        :param global_map: global map input (batch, H, W, 1) of size params.global_map_size
+        :param num_orientations: number of orientations n, evenly spaced over [0, 2pi)
+        :param stride: over-sampling factor of the images w.r.t. the local maps
+        :return (batch, n, N * stride, N * stride, 1): rotated global maps centered at the global map center
+        """
+
+        batch_size = global_map.shape.as_list()[0]
+        image_size = self.map_field_image_size() * stride
+        local_size = 28
+
+        global_height, global_width = self.params.global_map_size[:2]
+        scale_x = float(local_size * self.params.window_scaler) / global_width
+        scale_y = float(local_size * self.params.window_scaler) / global_height
+        factor = (image_size - 1) / (stride * (local_size - 1))
+
+        # rotation of each orientation as in transform_maps(), scaled s.t. image pixels match local map pixels
+        orientations = 2.0 * np.pi * np.arange(num_orientations) / num_orientations
+        theta = -orientations - 0.5 * np.pi
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        zero = np.zeros(num_orientations)
+        transform_m = np.stack((
+                        costheta * scale_x * factor, sintheta * scale_y * factor, zero,
+                        -sintheta * scale_x * factor, costheta * scale_y * factor, zero
+                    ), axis=1)
+        transform_m = tf.tile(tf.constant(transform_m[None], dtype=tf.float32), [batch_size, 1, 1])
+
+        # rotated global maps centered at the global map center
+        return batch_transformer(global_map, transform_m, (image_size, image_size))  # (batch, n, N, N, 1)
+
+    def encode_map_field(self, global_map):
+        """
+        Implements the precomputed map feature field for inference
+        The global map is rotated to n discretized orientations, down-scaled like the local maps
+        and encoded once by the (fully convolutional) map encoder. Particle map features are then
+        a bilinear lookup into the field, see lookup_map_features()
+        :param global_map: global map input (batch, H, W, 1) of size params.global_map_size
+        :return (batch, n, F, F, 8): map feature field for each of the n orientations
+        """
+
+        images = self.rotate_global_maps(global_map, self.map_field_orientations)
+
+        # rescale from [0, 2] to [-1, 1]    -> same as local maps
+        images = -(images - 1)
+
+        # encode one orientation at a time to bound the encoder activations
+        images = tf.transpose(images, [1, 0, 2, 3, 4])
+        map_field = tf.map_fn(self.map_field_model, images, fn_output_signature=tf.float32)  # (n, batch, F, F, 8)
+
+        return tf.transpose(map_field, [1, 0, 2, 3, 4])
+
+    def lookup_map_features(self, map_field, particle_states):
+        """
+        Implements the particles map features lookup into the precomputed map feature field
+        Orientation is rounded to the nearest field orientation, position is bilinearly interpolated
+        :param map_field: map feature field (batch, n, F, F, ch) from encode_map_field()
+            or the pair (field bank, map index) if map_bank is enabled
+        :param particle_states: particle states (batch, k, 3)
+        :return (batch * k, 14, 14, ch): map features of each particle
+        """
+
+        batch_size, num_particles = particle_states.shape.as_list()[:2]
+        if num_particles is None:
+            # active particles of kld adaptive mode
+            num_particles = tf.shape(particle_states)[1]
+        map_field, map_index = self.split_map(map_field)
+        if map_index is None:
+            map_index = tf.range(batch_size)
+        num_orientations, field_size = map_field.shape.as_list()[1:3]
+        feature_size = self.map_model.output_shape[1]
+        image_size = self.map_field_image_size()
+        local_size = 28
+
+        global_height, global_width = self.params.global_map_size[:2]
+        scale_x = float(local_size * self.params.window_scaler) / global_width
+        scale_y = float(local_size * self.params.window_scaler) / global_height
+
+        part_x, part_y, part_th = tf.unstack(particle_states, axis=-1, num=3)   # (bs, k)
+
+        # nearest field orientation
+        bin_width = 2.0 * np.pi / num_orientations
+        bins = tf.math.floormod(tf.cast(tf.round(part_th / bin_width), tf.int32), num_orientations)
+        theta = -tf.cast(bins, tf.float32) * bin_width - 0.5 * np.pi
+        costheta = tf.cos(theta)
+        sintheta = tf.sin(theta)
+
+        # particle position in the rotated image frame
+        translate_x = (part_x * 2.0 / global_width) - 1.0
+        translate_y = (part_y * 2.0 / global_height) - 1.0
+        rotated_x = costheta * translate_x - sintheta * translate_y
+        rotated_y = sintheta * translate_x + costheta * translate_y
+
+        # top-left pixel of the particle local map in the rotated image, particle is the bottom mid-point
+        offset_x = 0.5 * (image_size - 1) + 0.5 * (local_size - 1) * (rotated_x / scale_x - 1.0)
+        offset_y = 0.5 * (image_size - 1) + 0.5 * (local_size - 1) * (rotated_y / scale_y - 2.0)
+
+        # field is down-sampled by 2, sample feature_size pixels starting from offset / 2
+        zero = tf.zeros_like(offset_x)
+        scale = tf.fill(tf.shape(offset_x), (feature_size - 1) / field_size)
+        transform_m = tf.stack((
+                        scale, zero, (feature_size - 1 + offset_x) / field_size - 1.0,
+                        zero, scale, (feature_size - 1 + offset_y) / field_size - 1.0
+                    ), axis=-1)   # (bs, k, 6)
+
+        indices = tf.expand_dims(map_index * num_orientations, axis=1) + bins
+        map_field = tf.reshape(map_field, [-1] + map_field.shape.as_list()[2:])
+        map_features = batch_transformer(map_field, transform_m, (feature_size, feature_size), indices)
+
+        return tf.reshape(map_features,
+                [batch_size * num_particles] + map_features.shape.as_list()[2:])
+
+    def crop_rotated_maps(self, rotated_maps, particle_states):
+        """
+        Implements the local maps extraction from the pre-rotated global maps for inference
+        Orientation is rounded to the nearest cached heading and position to the nearest image pixel,
+        the local map is then a strided integer crop, no bilinear interpolation and no gradient w.r.t. particle states
+        :param rotated_maps: pre-rotated global maps (batch, n, N, N, ch) from rotate_global_maps()
+            or the pair (rotated map bank, map index (batch, ) or (batch, k)) if map_bank is enabled
+        :param particle_states: particle states (batch, k, 3)
+        :return (batch, k, 28, 28, ch): local maps of each particle
+        """
+
+        batch_size, num_particles = particle_states.shape.as_list()[:2]
+        if num_particles is None:
+            # active particles of kld adaptive mode
+            num_particles = tf.shape(particle_states)[1]
+        rotated_maps, map_index = self.split_map(rotated_maps)
+        if map_index is None:
+            map_index = tf.range(batch_size)
+        if map_index.shape.rank == 1:
+            map_index = map_index[:, None]
+        num_orientations, image_size = rotated_maps.shape.as_list()[1:3]
+        channels = rotated_maps.shape.as_list()[-1]
+        stride = self.rotated_map_stride
+        local_size = 28
+
+        global_height, global_width = self.params.global_map_size[:2]
+        scale_x = float(local_size * self.params.window_scaler) / global_width
+        scale_y = float(local_size * self.params.window_scaler) / global_height
+
+        part_x, part_y, part_th = tf.unstack(tf.stop_gradient(particle_states), axis=-1, num=3)   # (bs, k)
+
+        # nearest cached heading
+        bin_width = 2.0 * np.pi / num_orientations
+        bins = tf.math.floormod(tf.cast(tf.round(part_th / bin_width), tf.int32), num_orientations)
+        theta = -tf.cast(bins, tf.float32) * bin_width - 0.5 * np.pi
+        costheta = tf.cos(theta)
+        sintheta = tf.sin(theta)
+
+        # particle position in the rotated image frame, as in lookup_map_features()
+        translate_x = (part_x * 2.0 / global_width) - 1.0
+        translate_y = (part_y * 2.0 / global_height) - 1.0
+        rotated_x = costheta * translate_x - sintheta * translate_y
+        rotated_y = sintheta * translate_x + costheta * translate_y
+
+        # top-left pixel of the particle local map in the rotated image, local map pixels are stride image pixels apart
+        offset_x = 0.5 * (image_size - 1) + 0.5 * stride * (local_size - 1) * (rotated_x / scale_x - 1.0)
+        offset_y = 0.5 * (image_size - 1) + 0.5 * stride * (local_size - 1) * (rotated_y / scale_y - 2.0)
+        max_offset = image_size - 1 - stride * (local_size - 1)
+        offset_x = tf.clip_by_value(tf.cast(tf.round(offset_x), tf.int32), 0, max_offset)
+        offset_y = tf.clip_by_value(tf.cast(tf.round(offset_y), tf.int32), 0, max_offset)
+
+        # flat pixel index of the crop, each local map row is a (strided) run of one image row
+        steps = tf.range(local_size) * stride
+        image_index = map_index * num_orientations + bins   # (bs, k)
+        row_index = (image_index * image_size + offset_y)[:, :, None] + steps   # (bs, k, 28)
+        col_index = offset_x[:, :, None] + steps    # (bs, k, 28)
+        pixel_index = row_index[:, :, :, None] * image_size + col_index[:, :, None, :]  # (bs, k, 28, 28)
+
+        rotated_maps = tf.reshape(rotated_maps, [-1, channels])
+        local_maps = tf.gather(rotated_maps, pixel_index)
+
+        return tf.reshape(local_maps, [batch_size, num_particles, local_size, local_size, channels])
+
+    def observation_update(self, global_map, particle_states, observation, coarse_to_fine=False, prefilter=False,
+                            map_cache=False):
         """
         Implements a discriminative observation model for localization
         The model transforms global map to local maps for each particle,
         where a local map is a local view from state defined by the particle.
         :param global_map: global map input (batch, None, None, ch)
             assumes range[0, 2] were 0: occupied and 2: free space
+            or the map feature field (batch, n, F, F, 8) if map_feature_field is enabled
+            or the pre-rotated global maps (batch, n, N, N, 1) if rotated_map_cache is enabled
+            or the pair (map bank, map index (batch, )) if map_bank is enabled
         :param particle_states: particle states before observation update (batch, k, 3)
         :param observation: image observation (batch, 56, 56, ch)
+            or precomputed observation features (batch, 14, 14, 16) if batched_obs_encoder is enabled
+        :param coarse_to_fine: score all particles with the coarse head and only the best ones with the full model
+        :param prefilter: score only particles in free space, see free_space_particles()
+        :param map_cache: look up map features in the map feature cache, see cached_map_features()
         :return (batch, k): particle likelihoods in the log space (unnormalized)
         """
 
-        batch_size, num_particles = particle_states.shape.as_list()[:2]
+        num_particles = particle_states.shape.as_list()[1]
 
-        # transform global maps to local maps
-        local_maps = self.transform_maps(global_map, particle_states, (28, 28), self.params.window_scaler)
+        # get features from observation
+        if self.batched_obs_encoder:
+            # already encoded outside the recurrent loop
+            obs_features = observation
+        else:
+            obs_features = self.obs_model(observation)
+
+        if coarse_to_fine and num_particles is not None:
+            # with the pre-filter, particles outside free space are neither selected for nor kept at their full scores
+            valid = self.free_space_particles(global_map, particle_states) if prefilter else None
+            lik = self.coarse_to_fine_likelihoods(global_map, particle_states, obs_features, valid, map_cache)
+        elif prefilter and num_particles is not None:
+            # score only particles in free space, the others get a fixed low likelihood
+            valid = self.free_space_particles(global_map, particle_states)
+            lik = self.valid_particle_likelihoods(global_map, particle_states, obs_features, valid, map_cache)
+        else:
+            lik = self.chunked_particle_likelihoods(global_map, particle_states, obs_features, map_cache)
 
-        # rescale from [0, 2] to [-1, 1]    -> optional
+        return lik
+
+    def coarse_likelihoods(self, global_map, particle_states, obs_features):
+        """
+        Cheap particle scores from low resolution local maps, not calibrated to the full model
+        :param global_map: global map input (batch, None, None, ch)
+        :param particle_states: particle states (batch, k, 3)
+        :param obs_features: observation features (batch, 14, 14, 16)
+        :return (batch, k): coarse particle scores
+        """
+
+        map_features = self.coarse_map_features(global_map, particle_states)
+        obs_features = self.coarse_obs_model(obs_features)  # (bs, 14, 14, 8)
+
+        # dot product of the map features of each particle with the (broadcast) observation features
+        return tf.einsum('bkhwc,bhwc->bk', map_features, obs_features) / np.prod(obs_features.shape.as_list()[1:3])
+
+    def coarse_map_features(self, global_map, particle_states):
+        """
+        :param global_map: global map input (batch, None, None, ch)
+        :param particle_states: particle states (batch, k, 3)
+        :return (batch, k, 14, 14, 8): coarse map features of each particle
+        """
+
+        batch_size, num_particles = particle_states.shape.as_list()[:2]
+
+        # same window as the full (28, 28) local maps at half the resolution
+        local_maps = self.transform_maps(global_map, particle_states, (14, 14), 2 * self.params.window_scaler)
         local_maps = -(local_maps - 1)
+        local_maps = tf.reshape(local_maps, [batch_size * num_particles] + local_maps.shape.as_list()[2:])
 
-        # flatten batch and particle dimensions
-        local_maps = tf.reshape(local_maps,
-                [batch_size * num_particles] + local_maps.shape.as_list()[2:])
+        map_features = self.coarse_map_model(local_maps)
+        return tf.reshape(map_features, [batch_size, num_particles] + map_features.shape.as_list()[1:])
 
-        # get features from local maps
-        map_features = self.map_model(local_maps)
+    def coarse_to_fine_likelihoods(self, global_map, particle_states, obs_features, valid=None, map_cache=False):
+        """
+        Two-stage observation update: the coarse head scores all particles, the full model re-scores
+        the top coarse_top particles and a random slice of coarse_explore others
+        The coarse scores are calibrated to the full model with a per batch element least squares fit
+        on the re-scored particles, which keep their full scores
+        :param global_map: global map input (batch, None, None, ch)
+        :param particle_states: particle states (batch, k, 3)
+        :param obs_features: observation features (batch, 14, 14, 16)
+        :param valid: boolean mask of particles in free space (batch, k), valid particles are re-scored first
+            and invalid ones get a low likelihood, see invalid_particle_likelihoods() (optional)
+        :param map_cache: look up map features in the map feature cache (inference only)
+        :return (batch, k): particle likelihoods in the log space (unnormalized)
+        """
+
+        batch_size, num_particles = particle_states.shape.as_list()[:2]
+        num_top = min(self.params.coarse_top, num_particles)
+        num_explore = min(self.params.coarse_explore, num_particles - num_top)
+
+        coarse = self.coarse_likelihoods(global_map, particle_states, obs_features)   # (bs, k)
+
+        # top particles and a random slice of the remaining particles, valid particles first
+        selection = coarse
+        if valid is not None:
+            selection = tf.where(valid, coarse, INACTIVE_LOG_WEIGHT)
+        _, indices = tf.math.top_k(selection, k=num_top)
+        if num_explore > 0:
+            is_top = tf.reduce_any(tf.range(num_particles)[None, :, None] == indices[:, None, :], axis=-1)
+            explore_scores = tf.random.stateless_uniform(coarse.shape, seed=self.random_seed())
+            if valid is not None:
+                explore_scores = tf.where(valid, explore_scores + 1.0, explore_scores)
+            explore_scores = tf.where(is_top, -1.0, explore_scores)
+            _, explore_indices = tf.math.top_k(explore_scores, k=num_explore)
+            indices = tf.concat([indices, explore_indices], axis=-1)    # (bs, m)
+
+        indices = tf.stack([tf.tile(tf.range(batch_size)[:, None], [1, indices.shape[1]]), indices], axis=-1)  # (bs, m, 2)
+        fine = self.chunked_particle_likelihoods(global_map, tf.gather_nd(particle_states, indices), obs_features, map_cache)   # (bs, m)
+
+        # least squares fit fine ~ scale * coarse + offset on the re-scored particles
+        coarse_m = tf.gather_nd(coarse, indices)
+        coarse_mean = tf.reduce_mean(coarse_m, axis=-1, keepdims=True)
+        fine_mean = tf.reduce_mean(fine, axis=-1, keepdims=True)
+        covariance = tf.reduce_mean((coarse_m - coarse_mean) * (fine - fine_mean), axis=-1, keepdims=True)
+        variance = tf.reduce_mean(tf.square(coarse_m - coarse_mean), axis=-1, keepdims=True)
+        scale = covariance / (variance + 1e-6)
+        lik = scale * (coarse - coarse_mean) + fine_mean
+        lik = tf.tensor_scatter_nd_update(lik, indices, fine)
+
+        if valid is not None:
+            lik = self.invalid_particle_likelihoods(lik, valid)
+        return lik
+
+    def coarse_distillation_loss(self, global_map, particle_states, observation):
+        """
+        Trains the coarse head to rank particles like the full model
+        Coarse scores are calibrated at inference, so standardized scores are matched
+        :param global_map: global map input (batch, None, None, ch)
+        :param particle_states: particle states (batch, k, 3)
+        :param observation: image observation (batch, 56, 56, ch)
+        :return float: mean squared error of the standardized coarse and (fixed) full scores
+        """
 
-        # get features from observation
         obs_features = self.obs_model(observation)
+        fine = tf.stop_gradient(self.chunked_particle_likelihoods(global_map, particle_states, obs_features))
+        coarse = self.coarse_likelihoods(global_map, particle_states, tf.stop_gradient(obs_features))
+
+        def standardize(x):
+            mean, variance = tf.nn.moments(x, axes=[-1], keepdims=True)
+            return (x - mean) / tf.sqrt(variance + 1e-6)
+
+        return tf.reduce_mean(tf.square(standardize(coarse) - standardize(fine)))
+
+    def free_space_particles(self, global_map, particle_states):
+        """
+        Cheap occupancy lookup of each particle's cell in the global map
+        :param global_map: global map input (batch, None, None, ch), range [0, 2] were 0: occupied and 2: free space
+            or the pair (map bank, map index) if map_bank is enabled
+        :param particle_states: particle states (batch, k, 3)
+        :return (batch, k): boolean mask of particles inside the map and in free space
+        """
+
+        images, map_index = self.split_map(global_map)
+        map_height = tf.shape(images)[1]
+        map_width = tf.shape(images)[2]
+
+        cols = tf.cast(tf.floor(particle_states[:, :, 0]), tf.int32)
+        rows = tf.cast(tf.floor(particle_states[:, :, 1]), tf.int32)
+        inside = (cols >= 0) & (cols < map_width) & (rows >= 0) & (rows < map_height)
+
+        indices = tf.stack([tf.clip_by_value(rows, 0, map_height - 1), tf.clip_by_value(cols, 0, map_width - 1)], axis=-1)
+        if map_index is None:
+            occupancy = tf.gather_nd(images[:, :, :, 0], indices, batch_dims=1)     # (bs, k)
+        else:
+            image_index = tf.broadcast_to(map_index[:, None], tf.shape(rows))
+            occupancy = tf.gather_nd(images[:, :, :, 0], tf.concat([image_index[:, :, None], indices], axis=-1))
+
+        return inside & (occupancy > FREE_SPACE_MAP_VALUE)
+
+    def valid_particle_likelihoods(self, global_map, particle_states, obs_features, valid, map_cache=False):
+        """
+        Runs the learned observation model on the valid particles only
+        The valid particles are gathered into a static upper bound of k/8, k/4, k/2 or k particles
+        per batch element, the smallest that holds the valid particles of every batch element
+        :param global_map: global map input (batch, None, None, ch)
+        :param particle_states: particle states (batch, k, 3)
+        :param obs_features: observation features (batch, 14, 14, 16)
+        :param valid: boolean mask of particles to score (batch, k)
+        :param map_cache: look up map features in the map feature cache (inference only)
+        :return (batch, k): particle likelihoods in the log space (unnormalized), invalid particles
+            INVALID_LOG_LIKELIHOOD_MARGIN below the least likely valid particle of their batch element
+        """
+
+        batch_size, num_particles = particle_states.shape.as_list()[:2]
+
+        # valid particles first
+        order = tf.argsort(tf.cast(tf.logical_not(valid), tf.int32), axis=-1, stable=True)
+        num_valid = tf.reduce_max(tf.reduce_sum(tf.cast(valid, tf.int32), axis=-1))
+
+        bounds = sorted(set(max(num_particles // divisor, 1) for divisor in [8, 4, 2, 1]))
+        batch_indices = tf.tile(tf.range(batch_size)[:, None], [1, num_particles])
+
+        def score(bound):
+            def score_fn():
+                indices = tf.stack([batch_indices[:, :bound], order[:, :bound]], axis=-1)    # (bs, bound, 2)
+                lik = self.chunked_particle_likelihoods(
+                        global_map, tf.gather_nd(particle_states, indices), obs_features, map_cache
+                )
+                return tf.scatter_nd(indices, lik, [batch_size, num_particles])
+            return score_fn
+
+        branch = tf.reduce_sum(tf.cast(tf.constant(bounds[:-1]) < num_valid, tf.int32))
+        lik = tf.switch_case(branch, [score(bound) for bound in bounds])
+
+        return self.invalid_particle_likelihoods(lik, valid)
+
+    def invalid_particle_likelihoods(self, lik, valid):
+        """
+        :param lik: particle likelihoods in the log space (batch, k)
+        :param valid: boolean mask of particles in free space (batch, k)
+        :return (batch, k): likelihoods of valid particles, invalid particles
+            INVALID_LOG_LIKELIHOOD_MARGIN below the least likely valid particle of their batch element
+        """
+        # batch elements without valid particles keep a uniform (zero) likelihood
+        min_valid = tf.reduce_min(tf.where(valid, lik, np.inf), axis=-1, keepdims=True)
+        invalid_lik = tf.where(tf.math.is_finite(min_valid), min_valid - INVALID_LOG_LIKELIHOOD_MARGIN, 0.0)
+        return tf.where(valid, lik, tf.stop_gradient(invalid_lik))
+
+    def chunked_particle_likelihoods(self, global_map, particle_states, obs_features, map_cache=False):
+        """
+        Scores particles, optionally in chunks of particle_chunk_size
+        :param global_map: global map input (batch, None, None, ch) or the map feature field (batch, n, F, F, 8)
+        :param particle_states: particle states (batch, k, 3)
+        :param obs_features: observation features (batch, 14, 14, 16)
+        :param map_cache: look up map features in the map feature cache (inference only)
+        :return (batch, k): particle likelihoods in the log space (unnormalized)
+        """
+
+        num_particles = particle_states.shape.as_list()[1]
+
+        chunk_size = self.particle_chunk_size
+        if chunk_size and num_particles is not None and num_particles > chunk_size:
+            # run the map and joint encoders over particle chunks one after another to bound peak memory
+            liks = []
+            for idx in range(0, num_particles, chunk_size):
+                with tf.control_dependencies(liks[-1:]):
+                    liks.append(self.particle_likelihoods(
+                            global_map, particle_states[:, idx:idx+chunk_size], obs_features, map_cache
+                    ))
+            lik = tf.concat(liks, axis=1)
+        else:
+            lik = self.particle_likelihoods(global_map, particle_states, obs_features, map_cache)
+
+        return lik
+
+    def particle_likelihoods(self, global_map, particle_states, obs_features, map_cache=False):
+        """
+        Scores particles against the observation features
+        :param global_map: global map input (batch, None, None, ch) or the map feature field (batch, n, F, F, 8)
+            or the pre-rotated global maps (batch, n, N, N, 1)
+        :param particle_states: particle states (batch, k, 3)
+        :param obs_features: observation features (batch, 14, 14, 16)
+        :param map_cache: look up map features in the map feature cache (inference only)
+        :return (batch, k): particle likelihoods in the log space (unnormalized)
+        """
+
+        batch_size, num_particles = particle_states.shape.as_list()[:2]
+        if num_particles is None:
+            # active particles of kld adaptive mode
+            num_particles = tf.shape(particle_states)[1]
+
+        if self.map_feature_field:
+            # lookup features from the precomputed map feature field
+            map_features = self.lookup_map_features(global_map, particle_states)
+        elif map_cache:
+            # encode only the poses missing in the cache, inference only
+            map_features = self.cached_map_features(global_map, particle_states)
+        else:
+            map_features = self.encode_local_maps(global_map, particle_states)
 
-        # tile observation features
-        obs_features = tf.tile(tf.expand_dims(obs_features, axis=1), [1, num_particles, 1, 1, 1])
-        obs_features = tf.reshape(obs_features,
-                [batch_size * num_particles] + obs_features.shape.as_list()[2:])
+        lik = self.feature_likelihoods(map_features, obs_features)
+        return tf.reshape(lik, [batch_size, num_particles])
+
+    def feature_likelihoods(self, map_features, obs_features):
+        """
+        Likelihood head on the (already encoded) map features of each particle
+        :param map_features: map features (batch * k, 14, 14, 8)
+        :param obs_features: observation features (batch, 14, 14, 16)
+        :return (batch, k): particle likelihoods in the log space (unnormalized)
+        """
+
+        batch_size = obs_features.shape.as_list()[0]
 
         # sanity check
-        assert obs_features.shape.as_list()[:-1] == map_features.shape.as_list()[:-1]
+        assert obs_features.shape.as_list()[1:-1] == map_features.shape.as_list()[1:-1]
 
-        # merge map and observation features
-        joint_features = tf.concat([map_features, obs_features], axis=-1)
-        joint_features = self.joint_matrix_model(joint_features)
+        # merge map and observation features, observation features are broadcast over particles instead of tiled
+        joint_features = networks.broadcast_map_obs_encoder(self.joint_matrix_model, map_features, obs_features)
 
         # reshape to a vector
-        joint_features = tf.reshape(joint_features, [batch_size * num_particles, -1])
+        joint_features = tf.reshape(joint_features, [-1, int(np.prod(joint_features.shape.as_list()[1:]))])
         lik = self.joint_vector_model(joint_features)
-        lik = tf.reshape(lik, [batch_size, num_particles])
 
-        return lik
+        return tf.reshape(lik, [batch_size, -1])
+
+    def encode_local_maps(self, global_map, particle_states):
+        """
+        Extracts and encodes the local map of each particle
+        :param global_map: global map input (batch, None, None, ch) or the pre-rotated global maps (batch, n, N, N, 1)
+        :param particle_states: particle states (batch, k, 3)
+        :return (batch * k, 14, 14, 8): map features of each particle
+        """
+
+        batch_size, num_particles = particle_states.shape.as_list()[:2]
+        if num_particles is None:
+            # active particles of kld adaptive mode
+            num_particles = tf.shape(particle_states)[1]
+
+        if self.rotated_map_cache:
+            # crop local maps from the pre-rotated global maps
+            local_maps = self.crop_rotated_maps(global_map, particle_states)
+        else:
+            # transform global maps to local maps
+            local_maps = self.transform_maps(global_map, particle_states, (28, 28), self.params.window_scaler)
+
+        # rescale from [0, 2] to [-1, 1]    -> optional
+        local_maps = -(local_maps - 1)
+
+        # flatten batch and particle dimensions
+        local_maps = tf.reshape(local_maps,
+                [batch_size * num_particles] + local_maps.shape.as_list()[2:])
+
+        # get features from local maps
+        return self.map_model(local_maps)
+
+    def cached_map_features(self, global_map, particle_states):
+        """
+        Implements the map features lookup in the LRU map feature cache for inference
+        Particles are keyed by (map id, pose quantized to the map_cache_grid), map features of missing keys
+        are encoded at the center pose of their grid cell, s.t. cached features don't depend on the lookup order
+        :param global_map: global map input (batch, None, None, ch) or the pre-rotated global maps (batch, n, N, N, 1)
+            or the pair (map bank, map index) if map_bank is enabled
+        :param particle_states: particle states (batch, k, 3)
+        :return (batch * k, 14, 14, 8): map features of each particle
+        """
+
+        batch_size = particle_states.shape.as_list()[0]
+        images, map_index = self.split_map(global_map)
+        if map_index is None:
+            # map of each batch element, the cache is cleared whenever maps change, see map_images_state()
+            map_index = tf.range(batch_size)
+
+        grid_xy, grid_th = self.map_cache_grid
+        num_bins_th = int(round(2.0 * np.pi / grid_th))
+        part_x, part_y, part_th = tf.unstack(particle_states, axis=-1, num=3)   # (bs, k)
+
+        # quantized pose, 16 bits per component, packed with the map id into a non-negative int64 key
+        bin_x = tf.clip_by_value(tf.cast(tf.floor(part_x / grid_xy), tf.int64), 0, 0xffff)
+        bin_y = tf.clip_by_value(tf.cast(tf.floor(part_y / grid_xy), tf.int64), 0, 0xffff)
+        bin_th = tf.math.floormod(tf.cast(tf.round(part_th / (2.0 * np.pi / num_bins_th)), tf.int64), num_bins_th)
+        map_id = tf.broadcast_to(tf.cast(map_index, tf.int64)[:, None], tf.shape(bin_x))
+        keys = tf.bitwise.bitwise_or(
+                    tf.bitwise.bitwise_or(tf.bitwise.left_shift(map_id, 48), tf.bitwise.left_shift(bin_x, 32)),
+                    tf.bitwise.bitwise_or(tf.bitwise.left_shift(bin_y, 16), bin_th))
+
+        unique_keys, key_index = tf.unique(tf.reshape(keys, [-1]))
+
+        def encode_keys(miss_keys):
+            # center pose of the grid cell of each missing key, each with its own map index
+            miss_map = tf.cast(tf.bitwise.right_shift(miss_keys, 48), tf.int32)
+            miss_x = (tf.cast(tf.bitwise.bitwise_and(tf.bitwise.right_shift(miss_keys, 32), 0xffff), tf.float32) + 0.5) * grid_xy
+            miss_y = (tf.cast(tf.bitwise.bitwise_and(tf.bitwise.right_shift(miss_keys, 16), 0xffff), tf.float32) + 0.5) * grid_xy
+            miss_th = tf.cast(tf.bitwise.bitwise_and(miss_keys, 0xffff), tf.float32) * (2.0 * np.pi / num_bins_th)
+            miss_states = tf.stack([miss_x, miss_y, miss_th], axis=-1)[None]   # (1, m, 3)
+            return self.encode_local_maps((images, miss_map[None]), miss_states)
+
+        map_features = self.map_feature_cache.lookup(unique_keys, encode_keys)
+        return tf.gather(map_features, key_index)
 
     def resample(self, particle_states, particle_weights, alpha):
         """
@@ -157,8 +875,14 @@ class PFCell(keras.layers.AbstractRNNCell):
         particle_weights = particle_weights - tf.math.reduce_logsumexp(particle_weights, axis=-1, keepdims=True)
 
         # sample uniform weights
-        uniform_weights = tf.constant(np.log(1.0/float(num_particles)),
-                                    shape=(batch_size, num_particles), dtype=tf.float32)
+        if self.kld_adaptive:
+            # uniform over the active particles only
+            active = self.active_particles(particle_weights)
+            num_active = tf.reduce_sum(tf.cast(active, tf.float32), axis=-1, keepdims=True)
+            uniform_weights = tf.where(active, -tf.math.log(num_active), INACTIVE_LOG_WEIGHT)
+        else:
+            uniform_weights = tf.constant(np.log(1.0/float(num_particles)),
+                                        shape=(batch_size, num_particles), dtype=tf.float32)
 
         # build sample distribution q(s) and update particle weights
         if alpha < 1.0:
@@ -177,7 +901,7 @@ class PFCell(keras.layers.AbstractRNNCell):
             particle_weights = uniform_weights
 
         # sample particle indices according to q(s)
-        indices = tf.random.categorical(q_weights, num_particles,dtype=tf.int32)  # shape: (bs, k)
+        indices = self.sample_indices(q_weights)  # shape: (bs, k)
 
         # index into particles
         helper = tf.range(0, batch_size*num_particles, delta=num_particles, dtype=tf.int32)  # (batch, )
@@ -189,8 +913,130 @@ class PFCell(keras.layers.AbstractRNNCell):
         particle_weights = tf.reshape(particle_weights, (batch_size * num_particles, ))
         particle_weights = tf.gather(particle_weights, indices=indices, axis=0)  # (bs, k)
 
+        if self.kld_adaptive:
+            # keep the first n drawn particles, n from the KLD bound, pad the rest
+            num_active = self.kld_num_particles(particle_states)    # (bs, )
+            active = tf.range(num_particles)[None, :] < num_active[:, None]
+            if alpha == 1.0:
+                particle_weights = -tf.math.log(tf.cast(num_active[:, None], tf.float32))
+            particle_weights = tf.where(active, particle_weights, INACTIVE_LOG_WEIGHT)
+
         return particle_states, particle_weights
 
+    def sample_indices(self, q_weights):
+        """
+        Draws particle indices from the sample distribution q(s) with the inverse cdf, O(k log k)
+        :param q_weights: normalized sample distribution in log space (batch, k)
+        :return (batch, k): sampled particle indices
+            multinomial: k independent uniform draws
+            stratified: one uniform draw in each of the k equal strata of [0, 1)
+            systematic: single uniform offset shared by the k equal strata of [0, 1)
+        """
+
+        batch_size, num_particles = q_weights.shape.as_list()[:2]
+
+        if self.resample_scheme == 'multinomial':
+            u = tf.random.stateless_uniform((batch_size, num_particles), seed=self.random_seed())
+        elif self.resample_scheme == 'stratified':
+            u = tf.random.stateless_uniform((batch_size, num_particles), seed=self.random_seed())
+            u = (tf.range(num_particles, dtype=tf.float32)[None, :] + u) / num_particles
+        elif self.resample_scheme == 'systematic':
+            u = tf.random.stateless_uniform((batch_size, 1), seed=self.random_seed())
+            u = (tf.range(num_particles, dtype=tf.float32)[None, :] + u) / num_particles
+        else:
+            raise ValueError(self.resample_scheme)
+
+        # normalize cdf s.t. the last entry is exactly 1
+        cdf = tf.cumsum(tf.exp(q_weights), axis=-1)
+        cdf = cdf / cdf[:, -1:]
+        indices = tf.searchsorted(cdf, u, side='right', out_type=tf.int32)
+        indices = tf.minimum(indices, num_particles - 1)    # guard against round-off
+
+        if self.kld_adaptive and self.resample_scheme != 'multinomial':
+            # kld sampling keeps the first n draws, which must be in random order
+            order = tf.argsort(tf.random.stateless_uniform((batch_size, num_particles), seed=self.random_seed()), axis=-1)
+            indices = tf.gather(indices, order, batch_dims=1)
+
+        return indices
+
+    def resample_mask(self, particle_weights):
+        """
+        Selects the batch elements whose effective sample size is below resample_threshold
+        :param particle_weights: unnormalized particle weights in log space (batch, k)
+        :return (batch, ): boolean mask of batch elements to resample
+        """
+
+        num_particles = particle_weights.shape.as_list()[1]
+        if self.kld_adaptive:
+            # threshold relative to the active particles
+            num_particles = tf.reduce_sum(tf.cast(self.active_particles(particle_weights), tf.float32), axis=-1)
+
+        lin_weights = tf.nn.softmax(particle_weights, axis=-1)
+        n_eff = 1.0 / tf.reduce_sum(tf.square(lin_weights), axis=-1)    # (bs, )
+
+        return n_eff <= num_particles * self.resample_threshold
+
+    def active_particles(self, particle_weights):
+        """
+        Mask of active particles in kld adaptive mode, padded particles have INACTIVE_LOG_WEIGHT
+        Active particles always are the first n particles of each batch
+        :param particle_weights: particle weights in log space (batch, k)
+        :return (batch, k): boolean mask of active particles
+        """
+        return particle_weights > 0.5 * INACTIVE_LOG_WEIGHT
+
+    def kld_num_particles(self, particle_states):
+        """
+        Implements the KLD-sampling bound on the number of particles (Fox, 2003)
+        The i-th draw is accepted until i exceeds the number of particles required s.t. the KL divergence
+        between sample and true posterior is below kld_epsilon with probability 1 - kld_delta,
+        given the number of pose histogram bins occupied by the first i draws
+        :param particle_states: particle states drawn by resampling (batch, k, 3)
+        :return (batch, ): number of particles in [kld_min_particles, k]
+        """
+
+        batch_size, num_particles = particle_states.shape.as_list()[:2]
+        bin_xy, bin_th = self.params.kld_bin_size    # in pixels & radians
+
+        # pose histogram bin of each draw, x and y bin indices are assumed to be within +-2^19
+        part_x, part_y, part_th = tf.unstack(particle_states, axis=-1, num=3)   # (bs, k)
+        bin_x = tf.cast(tf.floor(part_x / bin_xy), tf.int64)
+        bin_y = tf.cast(tf.floor(part_y / bin_xy), tf.int64)
+        bin_t = tf.cast(tf.floor(tf.math.floormod(part_th, 2.0 * np.pi) / bin_th), tf.int64)
+        bins = (bin_x * 2**20 + bin_y) * 2**12 + bin_t
+
+        # a draw occupies a new bin if no earlier draw is in the same bin
+        order = tf.argsort(bins, axis=-1, stable=True)
+        sorted_bins = tf.gather(bins, order, batch_dims=1)
+        is_first = tf.concat([
+                        tf.ones((batch_size, 1), dtype=tf.bool),
+                        sorted_bins[:, 1:] != sorted_bins[:, :-1]
+        ], axis=-1)
+        is_first = tf.gather(is_first, tf.argsort(order, axis=-1), batch_dims=1)
+        num_bins = tf.cumsum(tf.cast(is_first, tf.float32), axis=-1)  # (bs, k) occupied bins after i draws
+
+        # Wilson-Hilferty approximation of the chi-square quantile
+        k = tf.maximum(num_bins - 1.0, 1.0)
+        a = 2.0 / (9.0 * k)
+        required = k / (2.0 * self.params.kld_epsilon) * tf.pow(1.0 - a + tf.sqrt(a) * self.kld_z, 3)
+        required = tf.where(num_bins > 1.0, required, 1.0)
+
+        # first number of draws that satisfies the bound
+        num_draws = tf.range(1, num_particles + 1, dtype=tf.float32)
+        satisfied = tf.logical_and(num_draws >= required, num_draws >= self.kld_min_particles)
+        num_active = tf.where(tf.reduce_any(satisfied, axis=-1),
+                            tf.argmax(tf.cast(satisfied, tf.int32), axis=-1, output_type=tf.int32) + 1,
+                            num_particles)
+
+        return num_active
+
+    def random_seed(self):
+        """
+        Draws a fresh seed for a stateless random op from the cell's generator
+        :return (2, ): int64 seed
+        """
+        return self.rng.make_seeds(1)[:, 0]
+
     def transition_model(self, particle_states, odometry):
         """
         Implements a stochastic transition model for localization
@@ -208,7 +1054,7 @@ class PFCell(keras.layers.AbstractRNNCell):
         odom_x, odom_y, odom_th = tf.unstack(odometry, axis=-1, num=3)
 
         # sample noisy orientation
-        noise_th = tf.random.normal(part_th.get_shape(), mean=0.0, stddev=1.0) * rotation_std
+        noise_th = tf.random.stateless_normal(part_th.get_shape(), seed=self.random_seed(), mean=0.0, stddev=1.0) * rotation_std
 
         # add orientation noise before translation
         part_th = part_th + noise_th
@@ -220,15 +1066,16 @@ class PFCell(keras.layers.AbstractRNNCell):
         delta_th = odom_th
 
         # sample noisy translation
-        delta_x = delta_x + tf.random.normal(delta_x.get_shape(), mean=0.0, stddev=1.0) * translation_std
-        delta_y = delta_y + tf.random.normal(delta_y.get_shape(), mean=0.0, stddev=1.0) * translation_std
+        delta_x = delta_x + tf.random.stateless_normal(delta_x.get_shape(), seed=self.random_seed(), mean=0.0, stddev=1.0) * translation_std
+        delta_y = delta_y + tf.random.stateless_normal(delta_y.get_shape(), seed=self.random_seed(), mean=0.0, stddev=1.0) * translation_std
 
         return tf.stack([part_x + delta_x , part_y + delta_y, part_th + delta_th], axis=-1)   # (bs, k, 3)
 
     def transform_maps(self, global_map, particle_states, local_map_size, window_scaler=None):
         """
         Implements global to local map transformation
-        :param global_map: global map input (batch, None, None, ch)
+        :param global_map: global map input (batch, None, None, ch) or its mip level if map_mipmap is enabled
+            or the pair (map bank, map index (batch, ) or (batch, k)) if map_bank is enabled
         :param particle_states: particle states that define local view for transformation (batch, k, 3)
         :param local_map_size: size of output local maps (height, width)
         :param window_scaler: global map will be down-scaled by some int factor
@@ -238,17 +1085,22 @@ class PFCell(keras.layers.AbstractRNNCell):
 
         # flatten batch and particle
         batch_size, num_particles = particle_states.shape.as_list()[:2]
+        if num_particles is None:
+            # active particles of kld adaptive mode
+            num_particles = tf.shape(particle_states)[1]
         total_samples = batch_size * num_particles
         flat_states = tf.reshape(particle_states, [total_samples, 3])
 
-        # define variables
+        global_map, map_index = self.split_map(global_map)
+
+        # define variables, size of the full resolution global map
         input_shape = tf.shape(global_map)
-        global_height = tf.cast(input_shape[1], tf.float32)
-        global_width = tf.cast(input_shape[2], tf.float32)
+        global_height = tf.cast(input_shape[1] * self.mip_scale, tf.float32)
+        global_width = tf.cast(input_shape[2] * self.mip_scale, tf.float32)
         height_inverse = 1.0 / global_height
         width_inverse = 1.0 / global_width
-        zero = tf.constant(0, dtype=tf.float32, shape=(total_samples, ))
-        one = tf.constant(1, dtype=tf.float32, shape=(total_samples, ))
+        zero = tf.zeros_like(flat_states[:, 0])
+        one = tf.ones_like(flat_states[:, 0])
 
         # normalize orientations and precompute cos and sin functions
         theta = -flat_states[:, 2] - 0.5 * np.pi
@@ -258,8 +1110,10 @@ class PFCell(keras.layers.AbstractRNNCell):
         # construct affine transformation matrix step-by-step
 
         # 1: translate the global map s.t. the center is at the particle state
-        translate_x = (flat_states[:, 0] * width_inverse * 2.0) - 1.0
-        translate_y = (flat_states[:, 1] * height_inverse * 2.0) - 1.0
+        # a mip level pixel averages mip_scale global map pixels, its sample point is shifted by half the box
+        mip_offset = 0.5 * (self.mip_scale - 1)
+        translate_x = ((flat_states[:, 0] - mip_offset) * width_inverse * 2.0) - 1.0
+        translate_y = ((flat_states[:, 1] - mip_offset) * height_inverse * 2.0) - 1.0
 
         transm1 = tf.stack((one, zero, translate_x, zero, one, translate_y, zero, zero, one), axis=1)
         transm1 = tf.reshape(transm1, [total_samples, 3, 3])
@@ -281,7 +1135,7 @@ class PFCell(keras.layers.AbstractRNNCell):
         scalem = tf.reshape(scalem, [total_samples, 3, 3])
 
         # 4: translate the local map s.t. the particle defines the bottom mid_point instead of the center
-        translate_y2 = tf.constant(-1.0, dtype=tf.float32, shape=(total_samples, ))
+        translate_y2 = -one
 
         transm2 = tf.stack((one, zero, zero, zero, one, translate_y2, zero, zero, one), axis=1)
         transm2 = tf.reshape(transm2, [total_samples, 3, 3])
@@ -292,11 +1146,21 @@ class PFCell(keras.layers.AbstractRNNCell):
         # reshape to format expected by spatial transform network
         transform_m = tf.reshape(transform_m[:, :2], [batch_size, num_particles, 6])
 
-        # iterate over num_particles to tranform image using spatial transform network
-        list = []
-        for i in range(num_particles):
-            list.append(transformer(global_map, transform_m[:, i], local_map_size))
-        local_maps = tf.stack(list, axis=1)
+        if self.batched_transform:
+            # tranform image for all particles at once using batched spatial transform network
+            indices = None
+            if map_index is not None:
+                # each sample (or particle) transforms its map of the bank
+                if map_index.shape.rank == 1:
+                    map_index = map_index[:, None]
+                indices = tf.broadcast_to(map_index, tf.shape(transform_m)[:2])
+            local_maps = batch_transformer(global_map, transform_m, local_map_size, indices)
+        else:
+            # iterate over num_particles to tranform image using spatial transform network
+            list = []
+            for i in range(num_particles):
+                list.append(transformer(global_map, transform_m[:, i], local_map_size))
+            local_maps = tf.stack(list, axis=1)
 
         # reshape if any information has lost in spatial transform network
         local_maps = tf.reshape(local_maps,
@@ -304,31 +1168,145 @@ class PFCell(keras.layers.AbstractRNNCell):
 
         return local_maps   # (batch_size, num_particles, 28, 28, 1)
 
-def pfnet_model(params):
+class MapFeatureCache(tf.Module):
+    """
+    Fixed size LRU cache of map features in device variables, keyed by non-negative int64 keys
+    A lookup compares its keys against all cached keys, meant for a few thousand entries
+    """
+    def __init__(self, capacity, feature_shape):
+        """
+        :param capacity: max. number of cached entries
+        :param feature_shape: shape of the features of one entry, e.g. (14, 14, 8)
+        """
+        super(MapFeatureCache, self).__init__()
+        self.capacity = capacity
+
+        self.keys = tf.Variable(tf.fill([capacity], tf.constant(-1, tf.int64)), trainable=False)   # -1: empty
+        self.features = tf.Variable(tf.zeros([capacity, *feature_shape]), trainable=False)
+        self.last_used = tf.Variable(tf.fill([capacity], -1), trainable=False)
+        self.step = tf.Variable(0, trainable=False)
+
+        # lookup statistics
+        self.hits = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.misses = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+    def lookup(self, keys, compute_fn):
+        """
+        Looks up the features of the keys, missing keys are computed and replace the least recently used entries
+        :param keys: unique keys (n, ) int64
+        :param compute_fn: function of the missing keys (m, ) returning their features (m, ...)
+        :return (n, ...): features of each key
+        """
+        self.step.assign_add(1)
+
+        match = tf.equal(keys[:, None], self.keys[None, :])    # (n, capacity)
+        hit = tf.reduce_any(match, axis=1)
+        hit_index = tf.cast(tf.where(hit)[:, 0], tf.int32)
+        miss_index = tf.cast(tf.where(tf.logical_not(hit))[:, 0], tf.int32)
+
+        hit_slots = tf.gather(tf.argmax(tf.cast(match, tf.int32), axis=1, output_type=tf.int32), hit_index)
+        hit_features = tf.gather(self.features, hit_slots)
+        self.last_used.scatter_nd_update(hit_slots[:, None], tf.fill(tf.shape(hit_slots), self.step))
+
+        miss_keys = tf.gather(keys, miss_index)
+        miss_features = compute_fn(miss_keys)
+
+        # evict the least recently used entries, hits of this lookup are evicted last
+        num_stored = tf.minimum(tf.size(miss_keys), self.capacity)
+        _, slots = tf.math.top_k(-self.last_used, k=num_stored)
+        self.keys.scatter_nd_update(slots[:, None], miss_keys[:num_stored])
+        self.features.scatter_nd_update(slots[:, None], miss_features[:num_stored])
+        self.last_used.scatter_nd_update(slots[:, None], tf.fill(tf.shape(slots), self.step))
+
+        self.hits.assign_add(tf.cast(tf.size(hit_index), tf.int64))
+        self.misses.assign_add(tf.cast(tf.size(miss_index), tf.int64))
+
+        return tf.dynamic_stitch([hit_index, miss_index], [hit_features, miss_features])
+
+    def clear(self):
+        """
+        Drops all cached entries, the lookup statistics are kept
+        """
+        self.keys.assign(tf.fill([self.capacity], tf.constant(-1, tf.int64)))
+        self.last_used.assign(tf.fill([self.capacity], -1))
+
+    def stats(self):
+        """
+        :return dict: number of hits and misses of all lookups so far
+        """
+        return {'hits': int(self.hits.numpy()), 'misses': int(self.misses.numpy())}
+
+class ObservationEncoder(keras.layers.Layer):
+    """
+    Applies the PFCell observation model to the whole trajectory outside of the RNN
+    The cell keeps ownership of the observation model weights s.t. checkpoints stay compatible
+    """
+    def __init__(self, cell, **kwargs):
+        """
+        :param cell: PFCell owning the observation model
+        """
+        super(ObservationEncoder, self).__init__(**kwargs)
+
+        # bound method is not tracked, weights remain under the rnn cell
+        self.encode_observations = cell.encode_observations
+
+    def call(self, observations):
+        """
+        :param observations: image observations (batch, T, 56, 56, ch)
+        :return (batch, T, 14, 14, 16): observation features
+        """
+        return self.encode_observations(observations)
+
+def pfnet_model(params, trajlen=None):
+    """
+    Builds the pfnet model
+    :param params: parsed arguments
+    :param trajlen: number of time steps per call, defaults to params.trajlen
+        (e.g. params.bptt_steps to run a trajectory segment by segment)
+    :return keras.Model: maps (observation, odometry), (particle_states, particle_weights, global_map)
+        to the per step outputs and the final state
+    """
 
     batch_size = params.batch_size
     num_particles = params.num_particles
-    global_map_size = params.global_map_size
-    trajlen = params.trajlen
+    trajlen = params.trajlen if trajlen is None else trajlen
+    cell = PFCell(params)
+
     observation = keras.Input(shape=[trajlen, 56, 56, 3], batch_size=batch_size)   # (bs, T, 56, 56, 3)
     odometry = keras.Input(shape=[trajlen, 3], batch_size=batch_size)    # (bs, T, 3)
 
-    global_map = keras.Input(shape=global_map_size, batch_size=batch_size)   # (bs, H, W, 1)
+    # (bs, H, W, 1), the map feature field (bs, n, F, F, 8), the pre-rotated maps (bs, n, N, N, 1)
+    # or the mip level (bs, H / s, W / s, 1), see PFCell.map_state()
+    # with map_bank, one per unique map (m, ...) and paired with the per-sample map index (bs, )
+    global_map = keras.Input(shape=cell.map_shape[1:], batch_size=cell.map_shape[0])
     particle_states = keras.Input(shape=[num_particles, 3], batch_size=batch_size)   # (bs, k, 3)
     particle_weights = keras.Input(shape=[num_particles], batch_size=batch_size)    # (bs, k)
 
-    cell = PFCell(params)
     rnn = keras.layers.RNN(
                     cell, return_sequences=True,
                     return_state=params.return_state, stateful=params.stateful
     )
 
+    if cell.batched_obs_encoder:
+        # encode all time steps in one batched call before the recurrent loop
+        obs_features = ObservationEncoder(cell)(observation)   # (bs, T, 14, 14, 16)
+    else:
+        obs_features = observation
+
     state = [particle_states, particle_weights, global_map]
-    input = (observation, odometry)
+    constants = None
+    if cell.map_bank:
+        # recurrent state carries the map index, the map bank is passed to every step as is
+        map_index = keras.Input(shape=[], batch_size=batch_size, dtype=tf.int32)
+        state = [particle_states, particle_weights, map_index]
+        constants = [global_map]
+        global_map = (global_map, map_index)
+
+    input = (obs_features, odometry)
     if params.stateful:
-        x = rnn(inputs=input)
+        x = rnn(inputs=input, constants=constants)
     else:
-        x = rnn(inputs=input, initial_state=state)
+        x = rnn(inputs=input, initial_state=state, constants=constants)
     output, state = x[:2], x[2:]
 
     return keras.Model(
@@ -336,6 +1314,249 @@ def pfnet_model(params):
         outputs=([output, state])
     )
 
+def pfnet_steps(model, optimizer, params, compute_loss):
+    """
+    Builds compiled training and evaluation steps with a fixed input signature
+    :param model: pfnet model built by pfnet_model(), its time steps define the trajectory (segment) length
+    :param optimizer: optimizer applied in the training step
+    :param params: parsed arguments, params.jit_compile enables XLA
+    :param compute_loss: loss function (particle_states, particle_weights, true_states, map_pixel_in_meters) -> dict
+    :return train_step, eval_step: functions of (observation, odometry, true_states, init_particles,
+        init_particle_weights, global_map) returning the trajectory loss and the final particle_states
+        and particle_weights (after the motion update), train_step also applies the gradients
+        global_map is the pair (map bank, map index) if map_bank is enabled
+    """
+
+    batch_size = params.batch_size
+    num_particles = params.num_particles
+    trajlen = model.inputs[0].shape[1]
+    cell = [layer for layer in model.layers if isinstance(layer, keras.layers.RNN)][0].cell
+
+    # the map feature field approximates the local map encoder, train on the exact path
+    if cell.map_feature_field:
+        raise ValueError('map_feature_field is inference only, disable it for training')
+    # local maps cropped from the pre-rotated maps have no gradient w.r.t. particle states
+    if cell.rotated_map_cache:
+        raise ValueError('rotated_map_cache is inference only, disable it for training')
+
+    # map size can vary between batches if maps are bucketed by size, see params.global_map_size
+    map_spec = tf.TensorSpec([batch_size, *params.global_map_size], tf.float32)
+    if cell.map_bank:
+        # map bank and per-sample map index
+        map_spec = (tf.TensorSpec([cell.map_bank_size, *params.global_map_size], tf.float32),
+                    tf.TensorSpec([batch_size], tf.int32))
+    input_signature = [
+        tf.TensorSpec([batch_size, trajlen, 56, 56, 3], tf.float32),    # observation
+        tf.TensorSpec([batch_size, trajlen, 3], tf.float32),    # odometry
+        tf.TensorSpec([batch_size, trajlen, 3], tf.float32),    # true_states
+        tf.TensorSpec([batch_size, num_particles, 3], tf.float32),  # init_particles
+        tf.TensorSpec([batch_size, num_particles], tf.float32),     # init_particle_weights
+        map_spec,   # global_map
+    ]
+    jit_compile = getattr(params, 'jit_compile', False)
+
+    # the input signature is fixed, any retracing means python overhead and recompilation on every call
+    num_traces = {'train_step': 0, 'eval_step': 0}
+    def report_trace(name):
+        num_traces[name] += 1
+        if num_traces[name] > 1:
+            print(f'=====> warning: {name} retraced {num_traces[name]} times')
+
+    def map_input(global_map):
+        # map state of every mode (feature field, pre-rotated maps or mip level), built in the step
+        # s.t. callers keep passing the global map, the global map itself otherwise
+        return cell.map_state(global_map)
+
+    def forward(observation, odometry, true_states, init_particles, init_particle_weights, global_map, training):
+        # start trajectory with initial particles and weights
+        state = [init_particles, init_particle_weights, global_map]
+        model_input = ([observation, odometry], state)
+
+        output, state = model(model_input, training=training)
+
+        particle_states, particle_weights = output
+        loss_dict = compute_loss(particle_states, particle_weights, true_states, params.map_pixel_in_meters)
+        return loss_dict['pred'], state[0], state[1]
+
+    @tf.function(input_signature=input_signature, jit_compile=jit_compile)
+    def train_step(observation, odometry, true_states, init_particles, init_particle_weights, global_map):
+        report_trace('train_step')
+        global_map = map_input(global_map)
+
+        # enable auto-differentiation
+        with tf.GradientTape() as tape:
+            loss_pred, particle_states, particle_weights = forward(
+                    observation, odometry, true_states, init_particles, init_particle_weights, global_map, training=True
+            )
+            loss_total = loss_pred
+            if cell.coarse_to_fine:
+                # distill the full model into the coarse head on the initial particles
+                loss_total = loss_total + cell.coarse_distillation_loss(global_map, init_particles, observation[:, 0])
+
+        # run one step of gradient descent
+        gradients = tape.gradient(loss_total, model.trainable_weights)
+        optimizer.apply_gradients(zip(gradients, model.trainable_weights))
+
+        return loss_pred, particle_states, particle_weights
+
+    @tf.function(input_signature=input_signature, jit_compile=jit_compile)
+    def eval_step(observation, odometry, true_states, init_particles, init_particle_weights, global_map):
+        report_trace('eval_step')
+        global_map = map_input(global_map)
+
+        return forward(observation, odometry, true_states, init_particles, init_particle_weights, global_map, training=False)
+
+    return train_step, eval_step
+
+class Localizer(object):
+    """
+    Stateful single step particle filter for online localization
+    Runs compiled PFCell updates without the keras RNN wrapper,
+    the particle set and the global map (or its feature field) live in preallocated device variables
+    With map_bank, the map state holds the unique maps and each batch element a map index into it
+    """
+    def __init__(self, params, cell=None):
+        """
+        :param params: parsed arguments
+        :param cell: PFCell to run, e.g. the cell of a pfnet_model() with loaded weights (optional)
+        """
+        self.params = params
+        self.cell = PFCell(params) if cell is None else cell
+
+        self.particle_states = tf.Variable(tf.zeros(self.cell.states_shape), trainable=False)   # (bs, k, 3)
+        self.particle_weights = tf.Variable(tf.zeros(self.cell.weights_shape), trainable=False)  # (bs, k)
+        self.map_state = None   # allocated on first reset(), map size is not known before
+        self.map_index = None
+        if self.cell.map_bank:
+            self.map_index = tf.Variable(tf.zeros(self.cell.weights_shape[:1], dtype=tf.int32), trainable=False)    # (bs, )
+
+        # data dependent shapes can not be compiled with XLA
+        jit_compile = getattr(params, 'jit_compile', False) and not self.cell.kld_adaptive and self.cell.map_feature_cache is None
+        self.update_fn = tf.function(self.update_step, jit_compile=jit_compile)
+        self.estimate_fn = tf.function(self.estimate_step, jit_compile=jit_compile)
+
+    def reset(self, global_map, init_particles, init_particle_weights=None):
+        """
+        Starts a new episode
+        :param global_map: global map (batch, H, W, 1)
+            or the pair (map bank (m, H, W, 1), map index (batch, )) if map_bank is enabled
+        :param init_particles: initial particle states (batch, k, 3)
+        :param init_particle_weights: initial particle weights in log space (batch, k), uniform by default
+        """
+        batch_size, num_particles = self.cell.weights_shape
+        if init_particle_weights is None:
+            init_particle_weights = tf.constant(np.log(1.0/float(num_particles)),
+                                        shape=(batch_size, num_particles), dtype=tf.float32)
+
+        images, map_index = self.cell.split_map(global_map)
+        if map_index is not None:
+            self.map_index.assign(tf.convert_to_tensor(map_index, dtype=tf.int32))
+
+        # precomputed map feature field, if enabled, is encoded once per episode (and unique map)
+        map_state = self.cell.map_images_state(tf.convert_to_tensor(images, dtype=tf.float32))
+        if self.map_state is None:
+            # map size can change between episodes, e.g. bucketed maps
+            self.map_state = tf.Variable(map_state, trainable=False,
+                                    shape=tf.TensorShape([map_state.shape[0]] + [None] * (map_state.shape.rank - 1)))
+        else:
+            self.map_state.assign(map_state)
+
+        self.particle_states.assign(tf.convert_to_tensor(init_particles, dtype=tf.float32))
+        self.particle_weights.assign(tf.convert_to_tensor(init_particle_weights, dtype=tf.float32))
+
+    def reset_element(self, idx, global_map, init_particles, init_particle_weights=None):
+        """
+        Starts a new episode for a single batch element, the other batch elements are not affected
+        Requires a previous reset() of the whole batch, which allocates the map state
+        :param idx: batch index
+        :param global_map: global map (H, W, 1) of the same size as in reset()
+            or the index of its map in the map bank if map_bank is enabled
+        :param init_particles: initial particle states (k, 3)
+        :param init_particle_weights: initial particle weights in log space (k, ), uniform by default
+        """
+        assert self.map_state is not None, 'call reset() before reset_element()'
+        num_particles = self.cell.weights_shape[1]
+        if init_particle_weights is None:
+            init_particle_weights = tf.constant(np.log(1.0/float(num_particles)), shape=(num_particles, ), dtype=tf.float32)
+
+        if self.cell.map_bank:
+            self.map_index[idx].assign(global_map)
+        else:
+            map_state = self.cell.map_state(tf.convert_to_tensor(global_map, dtype=tf.float32)[None])
+            self.map_state[idx].assign(map_state[0])
+        self.particle_states[idx].assign(tf.convert_to_tensor(init_particles, dtype=tf.float32))
+        self.particle_weights[idx].assign(tf.convert_to_tensor(init_particle_weights, dtype=tf.float32))
+
+    def relocalize(self, idx, observation, index):
+        """
+        Re-seeds the particles of a single batch element at the best poses of a relocalization index lookup,
+        e.g. after the robot was kidnapped, the map state is not affected
+        :param idx: batch index
+        :param observation: image observation (56, 56, ch)
+        :param index: RelocalizationIndex of the scene of the batch element, see relocalization.load_scene_index()
+        :return (n, 3): best poses of the lookup, best first
+        """
+        assert self.map_state is not None, 'call reset() before relocalize()'
+        num_particles = self.cell.weights_shape[1]
+
+        obs_features = self.cell.obs_model(tf.convert_to_tensor(observation, dtype=tf.float32)[None])
+        poses, particles, weights = index.seed_particles(obs_features, num_particles, getattr(self.params, 'reloc_top', 20))
+
+        self.particle_states[idx].assign(tf.convert_to_tensor(particles, dtype=tf.float32))
+        self.particle_weights[idx].assign(tf.convert_to_tensor(weights, dtype=tf.float32))
+        return poses
+
+    def update(self, observation, odometry, active=None):
+        """
+        Runs one particle filter step: observation update, resampling and motion update
+        :param observation: image observation at time t (batch, 56, 56, ch)
+        :param odometry: relative motion from time t to t+1 (batch, 3)
+        :param active: boolean mask of the batch elements to update (batch, ), all by default
+            the particle set of inactive batch elements is kept as is
+        :return (batch, k, 3) (batch, k): particle states and weights after the observation update
+            (but before the transition update)
+        """
+        assert self.map_state is not None, 'call reset() before update()'
+        if active is None:
+            active = tf.ones(self.cell.weights_shape[:1], dtype=tf.bool)
+        return self.update_fn(tf.convert_to_tensor(observation, dtype=tf.float32),
+                            tf.convert_to_tensor(odometry, dtype=tf.float32),
+                            tf.convert_to_tensor(active, dtype=tf.bool))
+
+    def update_step(self, observation, odometry, active):
+        if self.cell.batched_obs_encoder:
+            # cell expects encoded observations
+            observation = self.cell.obs_model(observation)
+
+        if self.cell.map_bank:
+            state = [self.particle_states.value(), self.particle_weights.value(), self.map_index.value()]
+            output, state = self.cell.call((observation, odometry), state, constants=[self.map_state.value()])
+        else:
+            state = [self.particle_states.value(), self.particle_weights.value(), self.map_state.value()]
+            output, state = self.cell.call((observation, odometry), state)
+
+        self.particle_states.assign(tf.where(active[:, None, None], state[0], self.particle_states))
+        self.particle_weights.assign(tf.where(active[:, None], state[1], self.particle_weights))
+
+        return output[0], output[1]
+
+    def estimate(self):
+        """
+        Weighted mean pose of the current particle set (after the transition update)
+        :return (batch, 3): estimated pose, orientation normalized to [-pi, +pi]
+        """
+        return self.estimate_fn()
+
+    def estimate_step(self):
+        lin_weights = tf.nn.softmax(self.particle_weights, axis=-1)
+        est_pose = tf.math.reduce_sum(self.particle_states * lin_weights[:, :, None], axis=1)
+
+        # normalize between [-pi, +pi]
+        part_x, part_y, part_th = tf.unstack(est_pose, axis=-1, num=3)
+        part_th = tf.math.floormod(part_th + np.pi, 2*np.pi) - np.pi
+
+        return tf.stack([part_x, part_y, part_th], axis=-1)
+
 if __name__ == '__main__':
     # obs_model = observation_model()
     # keras.utils.plot_model(obs_model, to_file='obs_model.png', show_shapes=True, dpi=64)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import os
+import pfnet
+import numpy as np
+from tqdm import tqdm
+import tensorflow as tf
+from utils import datautils, arguments
+
+class RelocalizationIndex(object):
+    """
+    Map features of a pose grid over the free space of one scene for global relocalization
+    The index is built once per scene with the map encoders of a PFCell with the trained coarse head (coarse_to_fine)
+    and stored as memory-mapped .npy files:
+        poses.npy (N, 3) float32, grid_size.npy (2, ) float32,
+        coarse_features.npy (N, 14 * 14 * 8) float16 and map_features.npy (N, 14, 14, 8) float16
+    A lookup scores an observation against all grid poses with a matrix product and seeds particles at the best ones,
+    instead of spreading them uniformly and waiting for the filter to converge
+
+    Size on disk is ~6.3 KB per grid pose. A 4000 x 4000 px map (80 m at 0.02 m per pixel) with the default
+    0.25 m / 16 heading grid has 320 x 320 x 16 = 1.6M poses, i.e. ~10 GB if it was all free space,
+    typically 1 - 3 GB for the free space of a house padded to that size
+    """
+    def __init__(self, cell, index_dir, num_candidates=2000, chunk_size=4096):
+        """
+        :param cell: PFCell the index was built with, e.g. the cell of a pfnet_model() with loaded weights
+        :param index_dir: directory of the index, see build()
+        :param num_candidates: number of best coarse scores re-scored by the full likelihood head
+        :param chunk_size: number of grid poses scored at once
+        """
+        if not cell.coarse_to_fine:
+            raise ValueError('relocalization index requires the coarse head, enable coarse_to_fine')
+        self.cell = cell
+        self.num_candidates = num_candidates
+        self.chunk_size = chunk_size
+
+        # memory-mapped, only the scored rows are read
+        self.poses = np.load(os.path.join(index_dir, 'poses.npy'), mmap_mode='r')
+        self.map_features = np.load(os.path.join(index_dir, 'map_features.npy'), mmap_mode='r')
+        self.grid_size = np.load(os.path.join(index_dir, 'grid_size.npy'))
+        self.coarse_features = np.load(os.path.join(index_dir, 'coarse_features.npy'), mmap_mode='r')
+
+    @classmethod
+    def build(cls, cell, global_map, index_dir, grid_size, num_candidates=2000, chunk_size=1024):
+        """
+        Encodes the local map of every grid pose in free space and writes the index
+        :param cell: PFCell to encode the map with
+        :param global_map: global map input (H, W, 1) as passed to the cell (padded to its size),
+            range [0, 2] were 0: occupied and 2: free space
+        :param index_dir: directory to write the index to, created if missing
+        :param grid_size: pose grid spacing: translation (pixels), rotation (radians)
+        :param num_candidates: number of best coarse scores re-scored by the full likelihood head, see __init__()
+        :param chunk_size: number of grid poses encoded at once
+        :return RelocalizationIndex: the opened index
+        """
+        if not cell.coarse_to_fine:
+            raise ValueError('relocalization index requires the coarse head, enable coarse_to_fine')
+        os.makedirs(index_dir, exist_ok=True)
+        global_map = np.asarray(global_map, np.float32)
+        step, bin_width = grid_size
+        num_orientations = int(round(2.0 * np.pi / bin_width))
+
+        # grid cell centers in free space, each at all grid orientations
+        rows, cols = np.meshgrid(np.arange(0.5 * step, global_map.shape[0], step),
+                                np.arange(0.5 * step, global_map.shape[1], step), indexing='ij')
+        free = global_map[rows.astype(np.int32), cols.astype(np.int32), 0] > pfnet.FREE_SPACE_MAP_VALUE
+        positions = np.stack([cols[free], rows[free]], axis=-1)
+        orientations = bin_width * np.arange(num_orientations)
+        poses = np.concatenate([
+                    np.repeat(positions, num_orientations, axis=0),
+                    np.tile(orientations, len(positions))[:, None]
+                ], axis=-1).astype(np.float32)   # (N, 3)
+        np.save(os.path.join(index_dir, 'poses.npy'), poses)
+        np.save(os.path.join(index_dir, 'grid_size.npy'), np.asarray([step, bin_width], np.float32))
+
+        # map state (feature field, pre-rotated maps or mip level, if enabled) of the cell
+        map_state = cell.map_images_state(tf.convert_to_tensor(global_map[None]))
+
+        feature_shape = cell.map_model.output_shape[1:]
+        map_features = np.lib.format.open_memmap(os.path.join(index_dir, 'map_features.npy'),
+                                mode='w+', dtype=np.float16, shape=(len(poses), *feature_shape))
+        coarse_size = int(np.prod(cell.coarse_map_model.output_shape[1:]))
+        coarse_features = np.lib.format.open_memmap(os.path.join(index_dir, 'coarse_features.npy'),
+                                mode='w+', dtype=np.float16, shape=(len(poses), coarse_size))
+
+        for start in tqdm(range(0, len(poses), chunk_size)):
+            states = tf.convert_to_tensor(poses[None, start:start+chunk_size])   # (1, m, 3)
+            if cell.map_feature_field:
+                features = cell.lookup_map_features(map_state, states)
+            else:
+                features = cell.encode_local_maps(map_state, states)
+            map_features[start:start+chunk_size] = features.numpy()
+            features = cell.coarse_map_features(map_state, states)
+            coarse_features[start:start+chunk_size] = tf.reshape(features, [features.shape[1], -1]).numpy()
+
+        map_features.flush()
+        coarse_features.flush()
+
+        return cls(cell, index_dir, num_candidates=num_candidates, chunk_size=chunk_size)
+
+    def query(self, obs_features, top_n):
+        """
+        Scores the observation against the grid poses of the index
+        All poses are scored by a (chunked) matrix product of their coarse features with the projected observation
+        features, only the best num_candidates are re-scored by the full likelihood head
+        :param obs_features: observation features (1, 14, 14, 16)
+        :param top_n: number of poses to return
+        :return (n, 3) (n, ): best grid poses and their likelihoods in the log space (unnormalized), best first
+        """
+
+        # coarse score is the dot product of the map and the projected observation features, see coarse_likelihoods()
+        obs_embedding = self.cell.coarse_obs_model(obs_features)
+        obs_embedding = tf.reshape(obs_embedding, [-1, 1]) / np.prod(obs_embedding.shape.as_list()[1:3])
+        coarse = np.concatenate([
+                    tf.matmul(np.asarray(self.coarse_features[start:start+self.chunk_size], np.float32),
+                            obs_embedding)[:, 0].numpy()
+                    for start in range(0, len(self.poses), self.chunk_size)
+                ])
+
+        candidates = np.arange(len(self.poses))
+        if self.num_candidates < len(candidates):
+            candidates = np.sort(np.argpartition(-coarse, self.num_candidates)[:self.num_candidates])
+
+        lik = np.concatenate([
+                    self.cell.feature_likelihoods(
+                        tf.convert_to_tensor(np.asarray(self.map_features[candidates[start:start+self.chunk_size]], np.float32)),
+                        obs_features)[0].numpy()
+                    for start in range(0, len(candidates), self.chunk_size)
+                ])
+
+        order = np.argsort(-lik)[:top_n]
+        return np.asarray(self.poses[candidates[order]]), lik[order]
+
+    def seed_particles(self, obs_features, num_particles, top_n=20):
+        """
+        Particles spread uniformly over the grid cells of the best poses of a lookup,
+        weighted by the likelihood of their grid pose
+        :param obs_features: observation features (1, 14, 14, 16)
+        :param num_particles: number of particles k
+        :param top_n: number of best poses the particles are seeded at
+        :return (n, 3) (k, 3) (k, ): best grid poses, particle states and weights in log space
+        """
+
+        poses, lik = self.query(obs_features, top_n)
+        step, bin_width = self.grid_size
+
+        # round robin over the best poses, jittered within their grid cell
+        choice = np.arange(num_particles) % len(poses)
+        jitter = np.random.uniform(-0.5, 0.5, (num_particles, 3)) * np.asarray([step, step, bin_width])
+        particles = poses[choice] + jitter
+
+        # normalize in log space
+        weights = lik[choice]
+        weights = weights - weights.max() - np.log(np.sum(np.exp(weights - weights.max())))
+        return poses, particles.astype(np.float32), weights.astype(np.float32)
+
+def scene_index_dir(index_root, map_wall):
+    """
+    :param index_root: root directory of the indexes of all scenes
+    :param map_wall: wall map image encoded as a png in a string
+    :return str: index directory of the scene of the wall map
+    """
+    return os.path.join(index_root, str(datautils.scene_id(map_wall).numpy()))
+
+def load_scene_index(params, cell, map_wall):
+    """
+    Opens the relocalization index of a scene, e.g. to pass to Localizer.relocalize()
+    :param params: parsed arguments
+    :param cell: PFCell the index was built with
+    :param map_wall: wall map image encoded as a png in a string
+    :return RelocalizationIndex: index of the scene in params.reloc_index_dir, see build_scene_indexes()
+    """
+    return RelocalizationIndex(cell, scene_index_dir(params.reloc_index_dir, map_wall), params.reloc_candidates)
+
+def build_scene_indexes(params, cell):
+    """
+    Builds the relocalization index of each scene of params.testfiles in params.reloc_index_dir
+    :param params: parsed arguments
+    :param cell: PFCell to encode the maps with
+    """
+
+    ds = tf.data.TFRecordDataset(params.testfiles).map(datautils.read_tfrecord)
+    for record in ds:
+        map_wall = record['map_wall'].numpy()
+        scene_dir = scene_index_dir(params.reloc_index_dir, map_wall)
+        if os.path.exists(os.path.join(scene_dir, 'poses.npy')):
+            continue
+
+        # zero pad map wall image as in transform_raw_record()
+        global_map = datautils.process_wall_map(map_wall)
+        global_map_size = params.global_map_size
+        if params.map_size_buckets:
+            bucket_size = datautils.map_bucket_size(max(global_map.shape[:2]), params.map_size_buckets)
+            global_map_size = (bucket_size, bucket_size, global_map_size[2])
+        global_map = datautils.map_to_tensor(datautils.pad_images([global_map], global_map_size))[0]
+
+        print(f'=====> Building relocalization index {scene_dir}')
+        RelocalizationIndex.build(cell, global_map, scene_dir, params.reloc_grid, params.reloc_candidates)
+
+if __name__ == '__main__':
+    params = arguments.parse_args()
+
+    # pf model
+    model = pfnet.pfnet_model(params)
+
+    # load model from checkpoint file
+    if params.load:
+        print("=====> Loading model from " + params.load)
+        model.load_weights(params.load)
+
+    build_scene_indexes(params, model.layers[-1].cell)   # RNN layer
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import pfnet
+import itertools
 import numpy as np
 from tqdm import tqdm
 import tensorflow as tf
@@ -22,17 +23,18 @@ def run_training(params):
     batch_size = params.batch_size
     num_particles = params.num_particles
     trajlen = params.trajlen
+    bptt_steps = params.bptt_steps
     num_train_batches = train_dataset_size() // batch_size
     num_valid_batches = valid_dataset_size() // batch_size
 
     # training data
-    train_ds = datautils.get_dataflow(params.trainfiles, params.batch_size, params.s_buffer_size, is_training=True)
+    train_ds = datautils.get_dataflow(params.trainfiles, params.batch_size, params.s_buffer_size, is_training=True, map_size_buckets=params.map_size_buckets, group_by_scene=params.map_bank)
 
     # validation data
-    test_ds = datautils.get_dataflow(params.testfiles, params.batch_size, params.s_buffer_size, is_training=True)
+    test_ds = datautils.get_dataflow(params.testfiles, params.batch_size, params.s_buffer_size, is_training=True, map_size_buckets=params.map_size_buckets, group_by_scene=params.map_bank)
 
-    # pf model
-    model = pfnet.pfnet_model(params)
+    # pf model, runs a trajectory segment of bptt_steps per call
+    model = pfnet.pfnet_model(params, trajlen=bptt_steps)
 
     # load model from checkpoint file
     if params.load:
@@ -42,6 +44,9 @@ def run_training(params):
     # Adam optimizer.
     optimizer = tf.optimizers.Adam(learning_rate=params.learningrate)
 
+    # compiled training and validation steps
+    train_step, eval_step = pfnet.pfnet_steps(model, optimizer, params, pfnet_loss.compute_loss)
+
     # Define metrics
     train_loss = keras.metrics.Mean('train_loss', dtype=tf.float32)
     test_loss = keras.metrics.Mean('test_loss', dtype=tf.float32)
@@ -52,15 +57,17 @@ def run_training(params):
     # repeat for a fixed number of epochs
     for epoch in range(params.epochs):
         itr = train_ds.as_numpy_iterator()
-        # run training over all training samples in an epoch
-        for idx in tqdm(range(num_train_batches)):
-            raw_record = next(itr)
+        # run training over all training samples in an epoch, can end earlier if maps are bucketed by size
+        for raw_record in tqdm(itertools.islice(itr, num_train_batches), total=num_train_batches):
             data_sample = datautils.transform_raw_record(raw_record, params)
 
             observation = tf.convert_to_tensor(data_sample['observation'], dtype=tf.float32)
             odometry = tf.convert_to_tensor(data_sample['odometry'], dtype=tf.float32)
             true_states = tf.convert_to_tensor(data_sample['true_states'], dtype=tf.float32)
-            global_map = tf.convert_to_tensor(data_sample['global_map'], dtype=tf.float32)
+            global_map = datautils.map_to_tensor(data_sample['global_map'])
+            if params.map_bank:
+                # bank of the unique maps of the batch, each sample looks up its map by index
+                global_map = (global_map, tf.convert_to_tensor(data_sample['map_index'], dtype=tf.int32))
             init_particles = tf.convert_to_tensor(data_sample['init_particles'], dtype=tf.float32)
             init_particle_weights = tf.constant(np.log(1.0/float(num_particles)),
                                         shape=(batch_size, num_particles), dtype=tf.float32)
@@ -73,27 +80,15 @@ def run_training(params):
             if params.stateful:
                 model.layers[-1].reset_states(state)    # RNN layer
 
-            # run training over trajectory
-            input = [observation, odometry]
-            model_input = (input, state)
-
-            # enable auto-differentiation
-            with tf.GradientTape() as tape:
-                # forward pass
-                output, state = model(model_input, training=True)
-
-                # compute loss
-                particle_states, particle_weights = output
-                loss_dict = pfnet_loss.compute_loss(particle_states, particle_weights, true_states, params.map_pixel_in_meters)
-                loss_pred = loss_dict['pred']
-
-            # compute gradients of the trainable variables with respect to the loss
-            gradients = tape.gradient(loss_pred, model.trainable_weights)
-            gradients = list(zip(gradients, model.trainable_weights))
-
-            # run one step of gradient descent
-            optimizer.apply_gradients(gradients)
-            train_loss(loss_pred)  # overall trajectory loss
+            # run training over trajectory segments with truncated BPTT: forward pass, loss and one step of gradient descent per segment
+            # particle state carries across segments, gradients do not
+            particle_states, particle_weights = init_particles, init_particle_weights
+            for idx in range(0, trajlen, bptt_steps):
+                loss_pred, particle_states, particle_weights = train_step(
+                        observation[:, idx:idx+bptt_steps], odometry[:, idx:idx+bptt_steps], true_states[:, idx:idx+bptt_steps],
+                        particle_states, particle_weights, global_map
+                )
+                train_loss(loss_pred)  # segment loss, equally long segments average to the trajectory loss
 
         # log epoch training stats
         with train_summary_writer.as_default():
@@ -105,15 +100,17 @@ def run_training(params):
 
         if params.run_validation:
             itr = test_ds.as_numpy_iterator()
-            # run validation over all validation samples in an epoch
-            for idx in tqdm(range(num_valid_batches)):
-                raw_record = next(itr)
+            # run validation over all validation samples in an epoch, can end earlier if maps are bucketed by size
+            for raw_record in tqdm(itertools.islice(itr, num_valid_batches), total=num_valid_batches):
                 data_sample = datautils.transform_raw_record(raw_record, params)
 
                 observation = tf.convert_to_tensor(data_sample['observation'], dtype=tf.float32)
                 odometry = tf.convert_to_tensor(data_sample['odometry'], dtype=tf.float32)
                 true_states = tf.convert_to_tensor(data_sample['true_states'], dtype=tf.float32)
-                global_map = tf.convert_to_tensor(data_sample['global_map'], dtype=tf.float32)
+                global_map = datautils.map_to_tensor(data_sample['global_map'])
+                if params.map_bank:
+                    # bank of the unique maps of the batch, each sample looks up its map by index
+                    global_map = (global_map, tf.convert_to_tensor(data_sample['map_index'], dtype=tf.int32))
                 init_particles = tf.convert_to_tensor(data_sample['init_particles'], dtype=tf.float32)
                 init_particle_weights = tf.constant(np.log(1.0/float(num_particles)),
                                             shape=(batch_size, num_particles), dtype=tf.float32)
@@ -126,19 +123,14 @@ def run_training(params):
                 if params.stateful:
                     model.layers[-1].reset_states(state)    # RNN layer
 
-                # run validation over trajectory
-                input = [observation, odometry]
-                model_input = (input, state)
-
-                # forward pass
-                output, state = model(model_input, training=False)
-
-                # compute loss
-                particle_states, particle_weights = output
-                loss_dict = pfnet_loss.compute_loss(particle_states, particle_weights, true_states, params.map_pixel_in_meters)
-                loss_pred = loss_dict['pred']
-
-                test_loss(loss_pred)  # overall trajectory loss
+                # run validation over trajectory segments: forward pass and loss per segment
+                particle_states, particle_weights = init_particles, init_particle_weights
+                for idx in range(0, trajlen, bptt_steps):
+                    loss_pred, particle_states, particle_weights = eval_step(
+                            observation[:, idx:idx+bptt_steps], odometry[:, idx:idx+bptt_steps], true_states[:, idx:idx+bptt_steps],
+                            particle_states, particle_weights, global_map
+                    )
+                    test_loss(loss_pred)  # segment loss, equally long segments average to the trajectory loss
 
             # log epoch validation stats
             with test_summary_writer.as_default():
@@ -22,16 +22,49 @@ def parse_args():
 
     # input configuration
     argparser.add_argument('--map_pixel_in_meters', type=float, default=0.02, help='The width (and height) of a pixel of the map in meters. Defaults to 0.02 for House3D data.')
+    argparser.add_argument('--map_size_buckets', nargs='*', type=int, default=[1000, 2000, 3000, 4000], help='Batch maps by size bucket (pixels) and pad them only up to the bucket size. Pass no value to pad all maps to 4000 x 4000 pixels.')
 
     argparser.add_argument('--init_particles_distr', type=str, default='tracking', help='Distribution of initial particles. Possible values: tracking / one-room.')
     argparser.add_argument('--init_particles_std', nargs='*', default=["0.3", "0.523599"], help='Standard deviations for generated initial particles for tracking distribution. Values: translation std (meters), rotation std (radians)')
     argparser.add_argument('--trajlen', type=int, default=24, help='Length of trajectories.')
+    argparser.add_argument('--bptt_steps', type=int, default=0, help='Number of backpropagation steps for training with truncated backpropagation through time (BPTT). Particle state carries across segments and each segment gets its own optimizer step. 0 backpropagates through the whole trajectory.')
 
     # PF configuration
     argparser.add_argument('--num_particles', type=int, default=30, help='Number of particles in Particle Filter.')
     argparser.add_argument('--transition_std', nargs='*', default=["0.0", "0.0"], help='Standard deviations for transition model. Values: translation std (meters), rotation std (radians)')
     argparser.add_argument('--resample', type=str, default='false', help='Resample particles in Particle Filter. Possible values: true / false.')
     argparser.add_argument('--alpha_resample_ratio', type=float, default=1.0, help='Trade-off parameter for soft-resampling in PF-net. Only effective if resample == true. Assumes values 0.0 < alpha <= 1.0. Alpha equal to 1.0 corresponds to hard-resampling.')
+    argparser.add_argument('--resample_threshold', type=float, default=1.0, help='Each batch element resamples only if its effective sample size is below resample_threshold * num_particles. Only effective if resample == true. Assumes values 0.0 < resample_threshold <= 1.0. Value 1.0 corresponds to resampling at every step.')
+    argparser.add_argument('--resample_scheme', type=str, default='multinomial', help='Scheme to draw particle indices in resampling. Possible values: multinomial / stratified / systematic.')
+    argparser.add_argument('--jit_compile', type=str, default='false', help='Compile the training and evaluation steps with XLA. Possible values: true / false.')
+    argparser.add_argument('--recompute_obs_update', type=str, default='false', help='Training only: recompute the observation update activations during backprop instead of keeping them for every time step. Possible values: true / false.')
+    argparser.add_argument('--particle_chunk_size', type=int, default=0, help='Run the map and joint encoders of the observation update over chunks of this many particles to bound peak memory. 0 processes all particles at once.')
+    argparser.add_argument('--occupancy_prefilter', type=str, default='false', help='Inference only: score only particles in free space of the global map with the observation model, the others get a low likelihood. Possible values: true / false.')
+    argparser.add_argument('--coarse_to_fine', type=str, default='false', help='Inference: score all particles with a cheap coarse head and only the best ones with the full observation model. Training: distill the full model into the coarse head. Possible values: true / false.')
+    argparser.add_argument('--coarse_top', type=int, default=32, help='Number of best particles (by coarse score) re-scored with the full observation model.')
+    argparser.add_argument('--coarse_explore', type=int, default=8, help='Number of random other particles re-scored with the full observation model.')
+    argparser.add_argument('--batched_transform', type=str, default='true', help='Extract local maps of all particles with a single batched gather. Possible values: true / false.')
+    argparser.add_argument('--batched_obs_encoder', type=str, default='false', help='Encode observations of the whole trajectory in one batched call before the recurrent loop. Possible values: true / false.')
+    argparser.add_argument('--map_feature_field', type=str, default='false', help='Inference only: encode the global map once per episode at discretized orientations and look up particle map features. Possible values: true / false.')
+    argparser.add_argument('--map_field_orientations', type=int, default=32, help='Number of discretized orientations of the map feature field.')
+    argparser.add_argument('--rotated_map_cache', type=str, default='false', help='Inference only: rotate the global map once per episode to discretized headings and crop particle local maps from the nearest heading instead of resampling them. Possible values: true / false.')
+    argparser.add_argument('--rotated_map_headings', type=int, default=64, help='Number of discretized headings of the rotated map cache.')
+    argparser.add_argument('--rotated_map_stride', type=int, default=1, help='Over-sampling of the rotated map cache w.r.t. the local maps, local maps are crops with this stride. Higher values quantize particle positions finer at stride^2 memory.')
+    argparser.add_argument('--map_mipmap', type=str, default='false', help='Sample local maps from the average pooled mip level of the global map closest to window_scaler instead of the full resolution map. Map sizes must be multiples of the mip scale. Possible values: true / false.')
+    argparser.add_argument('--map_bank', type=str, default='false', help='Pass a bank of the unique maps of a batch and a per-sample map index instead of one map per sample. Training batches are grouped by scene, evaluation batches need map_bank_size == batch_size. Possible values: true / false.')
+    argparser.add_argument('--map_bank_size', type=int, default=1, help='Number of maps in the map bank.')
+    argparser.add_argument('--kld_adaptive', type=str, default='false', help='Adapt the number of particles at every resample step with KLD-sampling, num_particles is the maximum. Only effective if resample == true. Possible values: true / false.')
+    argparser.add_argument('--kld_min_particles', type=int, default=10, help='Minimum number of particles for KLD-sampling.')
+    argparser.add_argument('--kld_epsilon', type=float, default=0.05, help='KL divergence bound of KLD-sampling.')
+    argparser.add_argument('--kld_delta', type=float, default=0.01, help='KLD-sampling bound holds with probability 1 - kld_delta.')
+    argparser.add_argument('--kld_bin_size', nargs='*', default=["0.5", "0.174533"], help='Pose histogram bin size for KLD-sampling. Values: translation (meters), rotation (radians)')
+    argparser.add_argument('--map_feature_cache', type=str, default='false', help='Inference only: cache map features in an LRU cache keyed by map and quantized particle pose, only poses missing in the cache are encoded. Possible values: true / false.')
+    argparser.add_argument('--map_cache_size', type=int, default=4096, help='Number of cached map features of the map feature cache.')
+    argparser.add_argument('--map_cache_grid', nargs='*', default=["0.05", "0.0872665"], help='Pose quantization of the map feature cache. Values: translation (meters), rotation (radians)')
+    argparser.add_argument('--reloc_grid', nargs='*', default=["0.25", "0.392699"], help='Pose grid of the relocalization index, requires coarse_to_fine. Values: translation (meters), rotation (radians)')
+    argparser.add_argument('--reloc_top', type=int, default=20, help='Number of best relocalization index poses particles are seeded at.')
+    argparser.add_argument('--reloc_candidates', type=int, default=2000, help='Number of best coarse scores of the relocalization index re-scored by the full likelihood head.')
+    argparser.add_argument('--reloc_index_dir', type=str, default='./reloc_index/', help='Root directory of the relocalization indexes, one per scene.')
 
     # training configuration
     argparser.add_argument('--batch_size', type=int, default=24, help='Minibatch size for training.')
@@ -45,9 +78,18 @@ def parse_args():
 
     params = argparser.parse_args()
 
+    assert 0.0 < params.resample_threshold <= 1.0
+    if params.bptt_steps == 0:
+        params.bptt_steps = params.trajlen
+    assert params.trajlen % params.bptt_steps == 0
+    assert params.resample_scheme in ['multinomial', 'stratified', 'systematic']
+
     # convert multi-input fileds to numpy arrays
     params.transition_std = np.array(params.transition_std, np.float32)
     params.init_particles_std = np.array(params.init_particles_std, np.float32)
+    params.kld_bin_size = np.array(params.kld_bin_size, np.float32)
+    params.map_cache_grid = np.array(params.map_cache_grid, np.float32)
+    params.reloc_grid = np.array(params.reloc_grid, np.float32)
 
     # build initial covariance matrix of particles, in pixels and radians
     particle_std = params.init_particles_std.copy()
@@ -57,6 +99,10 @@ def parse_args():
 
     params.transition_std = np.array(params.transition_std[0] / params.map_pixel_in_meters, params.transition_std[1])   # in pixels & radians
 
+    params.kld_bin_size[0] = params.kld_bin_size[0] / params.map_pixel_in_meters  # convert meters to pixels
+    params.map_cache_grid[0] = params.map_cache_grid[0] / params.map_pixel_in_meters  # convert meters to pixels
+    params.reloc_grid[0] = params.reloc_grid[0] / params.map_pixel_in_meters  # convert meters to pixels
+
     # fix seed
     np.random.seed(params.seed)
     tf.random.set_seed(params.seed)
@@ -65,18 +111,65 @@ def parse_args():
     params.stateful = False
     params.return_state = True
 
-    #HACK hardcode fix padding for map
-    params.global_map_size = (4000, 4000, 1)
+    # maps are padded per size bucket, otherwise to a fixed size
+    params.map_size_buckets = sorted(params.map_size_buckets)
+    if params.map_size_buckets:
+        params.global_map_size = (None, None, 1)
+    else:
+        #HACK hardcode fix padding for map
+        params.global_map_size = (4000, 4000, 1)
     params.window_scaler = 8.0
 
     # filter out info and warning messages
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
     # convert boolean fields
-    if params.resample not in ['false', 'true']:
-        raise ValurError
-    else:
-        params.resample = (params.resample == 'true')
+    for field in ['resample', 'batched_transform', 'batched_obs_encoder', 'map_feature_field', 'rotated_map_cache', 'map_mipmap', 'map_bank', 'map_feature_cache', 'kld_adaptive', 'jit_compile', 'recompute_obs_update', 'occupancy_prefilter', 'coarse_to_fine']:
+        if getattr(params, field) not in ['false', 'true']:
+            raise ValueError
+        setattr(params, field, getattr(params, field) == 'true')
+
+    # kld adaptive mode observes a data dependent number of particles, which XLA can not compile
+    if params.jit_compile and params.kld_adaptive:
+        raise ValueError('jit_compile requires a fixed number of particles, disable kld_adaptive')
+    # chunked, pre-filtered and coarse-to-fine observation updates assume a fixed number of particles
+    if params.kld_adaptive and (params.particle_chunk_size or params.occupancy_prefilter or params.coarse_to_fine):
+        raise ValueError('particle_chunk_size, occupancy_prefilter and coarse_to_fine require a fixed number of particles, disable kld_adaptive')
+    if params.jit_compile and params.map_feature_cache:
+        raise ValueError('jit_compile requires a fixed number of encoded local maps, disable map_feature_cache')
+
+    # map feature field is built for a fixed map size
+    if params.map_feature_field and params.map_size_buckets:
+        raise ValueError('map_feature_field requires a fixed map size, pass --map_size_buckets without values')
+    if params.rotated_map_cache and params.map_size_buckets:
+        raise ValueError('rotated_map_cache requires a fixed map size, pass --map_size_buckets without values')
+
+    # occupancy pre-filter looks up the raw global map
+    if params.map_feature_field and params.occupancy_prefilter:
+        raise ValueError('occupancy_prefilter requires the global map, disable map_feature_field')
+    if params.map_feature_field and params.coarse_to_fine:
+        raise ValueError('coarse_to_fine requires the global map, disable map_feature_field')
+
+    # rotated map cache replaces the global map in the recurrent state
+    if params.rotated_map_cache and params.map_feature_field:
+        raise ValueError('rotated_map_cache and map_feature_field are exclusive')
+    if params.rotated_map_cache and (params.occupancy_prefilter or params.coarse_to_fine):
+        raise ValueError('occupancy_prefilter and coarse_to_fine require the global map, disable rotated_map_cache')
+
+    # mip level replaces the global map in the recurrent state
+    if params.map_mipmap and (params.map_feature_field or params.rotated_map_cache):
+        raise ValueError('map_feature_field and rotated_map_cache are built from the global map, disable map_mipmap')
+    if params.map_mipmap and params.occupancy_prefilter:
+        raise ValueError('occupancy_prefilter requires the global map, disable map_mipmap')
+    assert 0 < params.map_bank_size <= params.batch_size
+
+    # map feature cache replaces the local map encoding, which the map feature field already skips
+    if params.map_feature_cache and params.map_feature_field:
+        raise ValueError('map_feature_cache and map_feature_field are exclusive')
+    assert params.map_cache_size > 0
+    mip_scale = 2 ** int(np.floor(np.log2(params.window_scaler)))
+    if params.map_mipmap and any(size % mip_scale for size in params.map_size_buckets):
+        raise ValueError(f'map_mipmap requires map size buckets that are multiples of {mip_scale}')
 
     gpus = tf.config.experimental.list_physical_devices('GPU')
     assert params.gpu_num < len(gpus)
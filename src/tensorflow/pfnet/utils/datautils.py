@@ -75,12 +75,11 @@ def process_wall_map(wallmap_feature):
     """
     decode wall map image from tfrecord data
     :param wallmap_feature: wall map image encoded as a png in a string
-    :return np.ndarray: image (H, W, 1)
+    :return np.ndarray: compact uint8 image (H, W, 1), normalize with normalize_map() once it is a tensor
     """
     floormap = np.atleast_3d(decode_image(wallmap_feature))
     # wall map image need to be transposed and inverted here
     floormap = 255 - np.transpose(floormap, axes=[1, 0, 2])
-    floormap = normalize_map(floormap.astype(np.float32))
     return floormap
 
 def normalize_map(x):
@@ -92,16 +91,26 @@ def normalize_map(x):
     # rescale to [0, 2], later zero padding will produce equivalent obstacle
     return x * (2.0/255.0)
 
+def map_to_tensor(global_map):
+    """
+    convert compact map batch to the normalized float32 tensor expected by pfnet
+    :param global_map: uint8 map images (N, H, W, 1)
+    :return tf.Tensor: normalized map images (N, H, W, 1)
+    """
+    # transfer uint8 and normalize on device
+    global_map = tf.cast(tf.convert_to_tensor(global_map, dtype=tf.uint8), tf.float32)
+    return normalize_map(global_map)
+
 def pad_images(images, new_shape):
     """
     zero-pad right and bottom of image to match new shape (largest in batch)
     :param images: list of np.ndarray map images
     :param new_shape: tuple of new (width, height, channel) of image
-    :return np.ndarray: zero-paded map images (N, new_H, new_W, new_ch)
+    :return np.ndarray: zero-paded map images (N, new_H, new_W, new_ch), same dtype as images
     """
     pad_images = []
     for img in images:
-        new_img = np.zeros(new_shape, np.float32)
+        new_img = np.zeros(new_shape, img.dtype)
         old_shape = img.shape
         new_img[:old_shape[0], :old_shape[1], :old_shape[2]] = img
         pad_images.append(new_img)
@@ -158,13 +167,18 @@ def transform_raw_record(raw_record, params):
     for map_roomid in raw_record['map_roomid']:
         map_roomids.append(process_roomid_map(map_roomid))
 
-    # process wall map
+    # process wall map, with map bank only once per unique map (scene) of the batch
     map_walls = []
-    org_map_shapes = []
+    map_index = []
+    bank_slots = {}
     for map_wall in raw_record['map_wall']:
-        wall_img = process_wall_map(map_wall)
-        map_walls.append(wall_img)
-        org_map_shapes.append(np.asarray(wall_img.shape))
+        if params.map_bank and map_wall in bank_slots:
+            map_index.append(bank_slots[map_wall])
+            continue
+        bank_slots[map_wall] = len(map_walls)
+        map_index.append(len(map_walls))
+        map_walls.append(process_wall_map(map_wall))
+    org_map_shapes = [np.asarray(map_walls[idx].shape) for idx in map_index]
 
     # generate random particle states
     trans_record['init_particles'] = random_particles(
@@ -175,9 +189,18 @@ def transform_raw_record(raw_record, params):
                                         map_roomids
                                     )   # (batch_size, num_particles, 3)
 
-    # zero pad map wall image
+    # zero pad map wall image, to the size bucket of the batch if maps are bucketed
+    if params.map_size_buckets:
+        bucket_size = map_bucket_size(max(shape[:2].max() for shape in org_map_shapes), params.map_size_buckets)
+        global_map_size = (bucket_size, bucket_size, global_map_size[2])
     pad_map_walls = pad_images(map_walls, global_map_size)
-    trans_record['global_map'] = np.stack(pad_map_walls)  # (batch_size, H, W, 1)
+    if params.map_bank:
+        # fixed size bank, unused slots are empty maps
+        if len(pad_map_walls) > params.map_bank_size:
+            raise ValueError(f'batch of {len(pad_map_walls)} scenes exceeds the map bank size {params.map_bank_size}')
+        pad_map_walls += [np.zeros_like(pad_map_walls[0])] * (params.map_bank_size - len(pad_map_walls))
+    trans_record['global_map'] = np.stack(pad_map_walls)  # (batch_size, H, W, 1) uint8, or (map_bank_size, H, W, 1)
+    trans_record['map_index'] = np.asarray(map_index, np.int32)   # (batch_size, )
     trans_record['org_map_shapes'] = np.stack(org_map_shapes)  # (batch_size, 3)
 
     return trans_record
@@ -248,13 +271,60 @@ def bounding_box(img):
 
     return rmin, rmax, cmin, cmax
 
-def get_dataflow(filenames, batch_size, s_buffer_size=100, is_training=False):
+def map_bucket_size(map_size, map_size_buckets):
+    """
+    smallest map size bucket that fits a map
+    :param map_size: largest side of the map in pixels
+    :param map_size_buckets: sorted list of bucket sizes in pixels
+    :return int: bucket size in pixels
+    """
+    for bucket_size in map_size_buckets:
+        if map_size <= bucket_size:
+            return bucket_size
+    raise ValueError(f'map of size {map_size} exceeds the largest map size bucket {map_size_buckets[-1]}')
+
+def map_size_bucket_id(map_wall, map_size_buckets):
+    """
+    map size bucket of a raw record, read from the png header without decoding the image
+    :param map_wall: wall map image encoded as a png in a string Tensor
+    :param map_size_buckets: sorted list of bucket sizes in pixels
+    :return Tensor: int64 index of the smallest bucket that fits the map
+    """
+    # png IHDR chunk: big-endian uint32 width and height at byte offset 16
+    map_shape = tf.io.decode_raw(tf.strings.substr(map_wall, 16, 8), tf.int32, little_endian=False)
+    map_size = tf.reduce_max(map_shape)
+    return tf.reduce_sum(tf.cast(map_size > tf.constant(map_size_buckets, dtype=tf.int32), tf.int64))
+
+def scene_id(map_wall):
+    """
+    scene of a raw record, trajectories of the same scene share the same encoded wall map
+    :param map_wall: wall map image encoded as a png in a string Tensor
+    :return Tensor: int64 hash of the encoded map
+    """
+    return tf.strings.to_hash_bucket_fast(map_wall, np.iinfo(np.int64).max)
+
+def get_dataflow(filenames, batch_size, s_buffer_size=100, is_training=False, map_size_buckets=None, group_by_scene=False):
 
     ds = tf.data.TFRecordDataset(filenames)
     if is_training:
         ds = ds.shuffle(s_buffer_size, reshuffle_each_iteration=True)
     ds = ds.map(read_tfrecord, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    ds = ds.batch(batch_size, drop_remainder=True).prefetch(tf.data.experimental.AUTOTUNE)
+    if group_by_scene:
+        # batch records of the same scene, s.t. a single map of the map bank serves the whole batch
+        # (implies the map size bucket), scenes with less than batch_size records left are dropped
+        ds = ds.apply(tf.data.experimental.group_by_window(
+                key_func=lambda record: scene_id(record['map_wall']),
+                reduce_func=lambda key, window: window.batch(batch_size, drop_remainder=True),
+                window_size=batch_size))
+    elif map_size_buckets:
+        # batch records of similar map size, s.t. maps are only padded up to their bucket size
+        ds = ds.apply(tf.data.experimental.group_by_window(
+                key_func=lambda record: map_size_bucket_id(record['map_wall'], map_size_buckets),
+                reduce_func=lambda key, window: window.batch(batch_size, drop_remainder=True),
+                window_size=batch_size))
+    else:
+        ds = ds.batch(batch_size, drop_remainder=True)
+    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
     # ds = ds.repeat(2)
 
     return ds
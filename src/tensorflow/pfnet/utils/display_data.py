@@ -9,7 +9,7 @@ def display_data(params):
     """
 
     # evaluation data
-    test_ds = datautils.get_dataflow(params.testfiles, params.batch_size, is_training=False)
+    test_ds = datautils.get_dataflow(params.testfiles, params.batch_size, is_training=False, map_size_buckets=params.map_size_buckets)
 
     itr = test_ds.as_numpy_iterator()
     raw_record = next(itr)
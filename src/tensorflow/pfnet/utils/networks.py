@@ -3,6 +3,44 @@
 import tensorflow as tf
 from tensorflow import keras
 
+##### custom layers ####
+def local_conv2d(inputs, kernel, kernel_size, strides, output_shape):
+    """
+    Locally connected 2D convolution with patch extraction and a single einsum
+    :param inputs: input features (N, H, W, ch)
+    :param kernel: kernel of keras.layers.LocallyConnected2D (implementation 1) (rows*cols, kh*kw*ch, filters)
+    :param kernel_size: tuple (kh, kw)
+    :param strides: tuple (sh, sw)
+    :param output_shape: tuple (rows, cols)
+    :return (N, rows, cols, filters): output features without bias and activation
+    """
+
+    kh, kw = kernel_size
+    sh, sw = strides
+    rows, cols = output_shape
+
+    # patches are flattened in (kh, kw, ch) order, same as the kernel
+    patches = tf.image.extract_patches(inputs, sizes=[1, kh, kw, 1], strides=[1, sh, sw, 1],
+                                        rates=[1, 1, 1, 1], padding='VALID')  # (N, rows, cols, kh*kw*ch)
+    patches = tf.reshape(patches, [-1, rows * cols, patches.shape[-1]])
+    x = tf.einsum('npk,pkf->npf', patches, kernel)
+
+    return tf.reshape(x, [-1, rows, cols, kernel.shape[-1]])
+
+class FastLocallyConnected2D(keras.layers.LocallyConnected2D):
+    """
+    keras.layers.LocallyConnected2D with the same weights, computed with local_conv2d()
+    """
+
+    def call(self, inputs):
+        if self.implementation != 1 or self.data_format != 'channels_last':
+            return super(FastLocallyConnected2D, self).call(inputs)
+
+        x = local_conv2d(inputs, self.kernel, self.kernel_size, self.strides, (self.output_row, self.output_col))
+        if self.use_bias:
+            x = x + self.bias
+        return self.activation(x)
+
 ##### helper fuctions for constructing layers ####
 def conv2_layer(
     filters, kernel_size,
@@ -30,7 +68,7 @@ def locallyconn2_layer(
     initializer = keras.initializers.VarianceScaling()
     regularizer = keras.regularizers.L2(1.0)
 
-    result = keras.layers.LocallyConnected2D(
+    result = FastLocallyConnected2D(
                 filters, kernel_size, strides, padding, data_format,
                 activation=activation, use_bias=use_bias,
                 kernel_initializer=initializer, kernel_regularizer=regularizer
@@ -85,6 +123,17 @@ def map_encoder():
 
     return keras.Model(inputs=local_maps, outputs=x, name="map_encoder")
 
+def map_field_encoder(map_model):
+    """
+    Fully convolutional view of the map encoder, shares layers (and weights) with map_model
+    :param map_model: map encoder model built with map_encoder()
+    :return keras.Model: encoder of maps with any size (N, H, W, 1) -> (N, ceil(H/2), ceil(W/2), 8)
+    """
+
+    maps = keras.Input(shape=[None, None, 1], name="maps")   # (N, H, W, 1)
+
+    return keras.models.clone_model(map_model, input_tensors=maps, clone_function=lambda layer: layer)
+
 def obs_encoder():
 
     observations = keras.Input(shape=[56, 56, 3], name="observations")   # (bs, 56, 56, 3)
@@ -139,6 +188,87 @@ def map_obs_encoder():
 
     return keras.Model(inputs=joint_matrix, outputs=x, name="map_obs_encoder")
 
+def coarse_map_encoder():
+    """
+    Cheap encoder of low resolution local maps for coarse particle scoring
+    """
+
+    local_maps = keras.Input(shape=[14, 14, 1], name="coarse_local_maps")   # (bs*np, 14, 14, 1)
+    x = local_maps
+
+    x = conv2_layer(8, 3, use_bias=True)(x)    # (bs*np, 14, 14, 8)
+    x = keras.layers.LayerNormalization(axis=-1)(x)
+    x = keras.layers.ReLU()(x)
+    assert x.get_shape().as_list()[1:4] == [14, 14, 8]
+
+    return keras.Model(inputs=local_maps, outputs=x, name="coarse_map_encoder")
+
+def coarse_obs_encoder():
+    """
+    Projects observation features to the coarse map feature space, the coarse score of a particle
+    is the dot product of its coarse map features and the projected observation features
+    """
+
+    obs_features = keras.Input(shape=[14, 14, 16], name="coarse_obs_features")   # (bs, 14, 14, 16)
+    x = obs_features
+
+    x = conv2_layer(8, 1, use_bias=True)(x)    # (bs, 14, 14, 8)
+    assert x.get_shape().as_list()[1:4] == [14, 14, 8]
+
+    return keras.Model(inputs=obs_features, outputs=x, name="coarse_obs_encoder")
+
+def broadcast_map_obs_encoder(map_obs_model, map_features, obs_features):
+    """
+    Evaluates map_obs_model on the concatenated map and observation features without tiling the observation features.
+    The locally connected layers are linear before their activation, so the observation contribution
+    is computed once per batch element and broadcast-added to the map contribution of every particle
+    :param map_obs_model: map observation encoder built with map_obs_encoder()
+    :param map_features: map features (bs*np, 14, 14, 8)
+    :param obs_features: observation features (bs, 14, 14, 16)
+    :return (bs*np, 5, 5, 16): same output as map_obs_model(concat([map_features, tiled obs_features]))
+    """
+
+    batch_size = obs_features.shape.as_list()[0]
+    map_channels = map_features.shape.as_list()[-1]
+
+    # pad manually to match different kernel sizes, see map_obs_encoder()
+    paddings = tf.constant([[0, 0], [1, 1,], [1, 1], [0, 0]])
+    inputs = {
+        (3, 3): (map_features, obs_features),
+        (5, 5): (tf.pad(map_features, paddings), tf.pad(obs_features, paddings)),
+    }
+
+    # locally connected layers in the order of map_obs_encoder(): kernel size 3, then 5
+    lc_layers = sorted([layer for layer in map_obs_model.layers if isinstance(layer, keras.layers.LocallyConnected2D)],
+                        key=lambda layer: layer.kernel_size)
+
+    conv_stack = []
+    for layer in lc_layers:
+        assert layer.implementation == 1
+        map_x, obs_x = inputs[layer.kernel_size]
+
+        # split the kernel (rows*cols, kh*kw*ch, filters) along the input channels
+        output_shape = (layer.output_row, layer.output_col)
+        kernel = tf.reshape(layer.kernel, [layer.output_row * layer.output_col, *layer.kernel_size, -1, layer.filters])
+        map_kernel = tf.reshape(kernel[:, :, :, :map_channels], [kernel.shape[0], -1, layer.filters])
+        obs_kernel = tf.reshape(kernel[:, :, :, map_channels:], [kernel.shape[0], -1, layer.filters])
+
+        map_x = local_conv2d(map_x, map_kernel, layer.kernel_size, layer.strides, output_shape)
+        obs_x = local_conv2d(obs_x, obs_kernel, layer.kernel_size, layer.strides, output_shape)
+
+        # broadcast-add the observation contribution over particles
+        x = tf.reshape(map_x, [batch_size, -1, *map_x.shape.as_list()[1:]]) + obs_x[:, None]
+        x = tf.reshape(x, [-1, *map_x.shape.as_list()[1:]])
+        if layer.use_bias:
+            x = x + layer.bias
+        conv_stack.append(layer.activation(x))   # (bs*np, 12, 12, 8)
+
+    x = tf.concat(conv_stack, axis=-1)   # (bs*np, 12, 12, 16)
+
+    x = tf.nn.max_pool2d(x, ksize=(3, 3), strides=(2, 2), padding='VALID')  # (bs*np, 5, 5, 16)
+
+    return x
+
 def likelihood_estimator():
 
     joint_vector = keras.Input(shape=[400], name="map_obs_joint_features")   # (bs*np, 5 * 5 * 16)
@@ -149,3 +279,28 @@ def likelihood_estimator():
     assert x.get_shape().as_list()[1] == 1
 
     return keras.Model(inputs=joint_vector, outputs=x, name="likelihood_estimator")
+
+if __name__ == '__main__':
+    # benchmark the joint encoder locally connected layer (14, 14, 24) -> (12, 12, 8) against keras
+    import time
+    import numpy as np
+
+    batch_size = 8
+    keras_layer = keras.layers.LocallyConnected2D(8, 3, padding='valid', activation='relu', use_bias=True)
+    fast_layer = FastLocallyConnected2D(8, 3, padding='valid', activation='relu', use_bias=True)
+    keras_layer.build((None, 14, 14, 24))
+    fast_layer.build((None, 14, 14, 24))
+    fast_layer.set_weights(keras_layer.get_weights())
+
+    for num_particles in [30, 300, 1000, 3000]:
+        x = tf.random.uniform((batch_size * num_particles, 14, 14, 24))
+        assert np.allclose(keras_layer(x), fast_layer(x), atol=1e-4)
+
+        for name, layer in [('keras', keras_layer), ('fast', fast_layer)]:
+            step = tf.function(layer)
+            step(x)     # trace and warm up
+            start = time.time()
+            for _ in range(10):
+                out = step(x)
+            out.numpy()
+            print(f'{name:5s} num_particles: {num_particles:5d}, {(time.time() - start) / 10 * 1000:8.2f} ms')
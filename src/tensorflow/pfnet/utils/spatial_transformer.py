@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import functools
+import numpy as np
 import tensorflow as tf
 # reference: https://github.com/AdaCompNUS/pfnet/blob/861b398c58574cc3e415896f3dd278a76cb2b383/transformer/spatial_transformer.py
 
@@ -55,13 +57,12 @@ def transformer(U, theta, out_size):
         idx_d = base_y1 + x1
 
         # use indices to lookup pixels in the flat image and restore
-        # channels dim
+        # channels dim, cast only the gathered pixels instead of the whole image
         im_flat = tf.reshape(im, tf.stack([-1, channels]))
-        im_flat = tf.cast(im_flat, 'float32')
-        Ia = tf.gather(im_flat, idx_a)
-        Ib = tf.gather(im_flat, idx_b)
-        Ic = tf.gather(im_flat, idx_c)
-        Id = tf.gather(im_flat, idx_d)
+        Ia = tf.cast(tf.gather(im_flat, idx_a), 'float32')
+        Ib = tf.cast(tf.gather(im_flat, idx_b), 'float32')
+        Ic = tf.cast(tf.gather(im_flat, idx_c), 'float32')
+        Id = tf.cast(tf.gather(im_flat, idx_d), 'float32')
 
         # and finally calculate interpolated values
         x0_f = tf.cast(x0, 'float32')
@@ -123,3 +124,106 @@ def transformer(U, theta, out_size):
 
     output = _transform(theta, U, out_size)
     return output
+
+@functools.lru_cache(maxsize=None)
+def sampling_grid(height, width):
+    """
+    Regular sampling grid of the output image, built once per output size
+    :param height: output image height
+    :param width: output image width
+    :return np.ndarray: grid (3, height*width) of homogeneous coordinates (x_t, y_t, 1) in [-1, 1]
+    """
+    def _linspace(num):
+        # float32 arithmetic of tf.linspace(-1.0, 1.0, num), s.t. sampled pixels match transformer()
+        step = np.float32(2.0) / np.float32(num - 1)
+        inner = np.float32(-1.0) + np.arange(1, num - 1, dtype=np.float32) * step
+        return np.concatenate([[-1.0], inner, [1.0]]).astype(np.float32)
+
+    x_t, y_t = np.meshgrid(_linspace(width), _linspace(height))
+    ones = np.ones(height * width, dtype=np.float32)
+    grid = np.vstack([x_t.flatten(), y_t.flatten(), ones])
+    grid.flags.writeable = False
+    return grid
+
+def batch_transformer(U, theta, out_size, indices=None):
+    """
+    Batched spatial transformer, samples k output images per input image with a single gather
+    :param U: input images (batch, H, W, ch)
+    :param theta: affine transformations (batch, k, 6)
+    :param out_size: size of output images (height, width)
+    :param indices: optional input image sampled by each transformation (batch, k),
+        defaults to the batch index. U can then hold any number of images (N, H, W, ch)
+    :return (batch, k, out_size[0], out_size[1], ch): transformed images, equivalent to
+        stacking transformer(U, theta[:, i], out_size) over i
+
+    Only the 4 bilinear neighbours of each output pixel are read from U (in U's dtype), so memory and
+    gather cost scale with k * out_size and not with the size of U. Gradients w.r.t. theta flow through
+    the bilinear weights.
+    """
+    # constants
+    num_batch = tf.shape(input=theta)[0]
+    height = tf.shape(input=U)[1]
+    width = tf.shape(input=U)[2]
+    channels = tf.shape(input=U)[3]
+    num_transforms = tf.shape(input=theta)[1]
+    out_height = out_size[0]
+    out_width = out_size[1]
+
+    height_f = tf.cast(height, 'float32')
+    width_f = tf.cast(width, 'float32')
+    zero = tf.zeros([], dtype='int32')
+    max_y = height - 1
+    max_x = width - 1
+
+    # Transform A x (x_t, y_t, 1)^T -> (x_s, y_s) for all transformations at once
+    theta = tf.reshape(tf.cast(theta, 'float32'), tf.stack([num_batch, num_transforms, 2, 3]))
+    grid = tf.constant(sampling_grid(out_height, out_width))    # (3, h*w)
+    T_g = tf.matmul(theta, grid)    # (batch, k, 2, h*w)
+    x = T_g[:, :, 0]
+    y = T_g[:, :, 1]
+
+    # scale indices from [-1, 1] to [0, width/height]
+    x = (x + 1.0) * (width_f) / 2.0
+    y = (y + 1.0) * (height_f) / 2.0
+
+    # do sampling
+    x0 = tf.cast(tf.floor(x), 'int32')
+    x1 = x0 + 1
+    y0 = tf.cast(tf.floor(y), 'int32')
+    y1 = y0 + 1
+
+    x0 = tf.clip_by_value(x0, zero, max_x)
+    x1 = tf.clip_by_value(x1, zero, max_x)
+    y0 = tf.clip_by_value(y0, zero, max_y)
+    y1 = tf.clip_by_value(y1, zero, max_y)
+    if indices is None:
+        base = tf.reshape(tf.range(num_batch) * width * height, [-1, 1, 1])
+    else:
+        base = tf.expand_dims(tf.cast(indices, 'int32') * width * height, axis=-1)
+    base_y0 = base + y0 * width
+    base_y1 = base + y1 * width
+    idx_a = base_y0 + x0
+    idx_b = base_y1 + x0
+    idx_c = base_y0 + x1
+    idx_d = base_y1 + x1
+
+    # use indices to lookup pixels in the flat image, cast only the gathered pixels
+    im_flat = tf.reshape(U, tf.stack([-1, channels]))
+    Ia = tf.cast(tf.gather(im_flat, idx_a), 'float32')    # (batch, k, h*w, ch)
+    Ib = tf.cast(tf.gather(im_flat, idx_b), 'float32')
+    Ic = tf.cast(tf.gather(im_flat, idx_c), 'float32')
+    Id = tf.cast(tf.gather(im_flat, idx_d), 'float32')
+
+    # and finally calculate interpolated values
+    x0_f = tf.cast(x0, 'float32')
+    x1_f = tf.cast(x1, 'float32')
+    y0_f = tf.cast(y0, 'float32')
+    y1_f = tf.cast(y1, 'float32')
+    wa = tf.expand_dims(((x1_f - x) * (y1_f - y)), -1)
+    wb = tf.expand_dims(((x1_f - x) * (y - y0_f)), -1)
+    wc = tf.expand_dims(((x - x0_f) * (y1_f - y)), -1)
+    wd = tf.expand_dims(((x - x0_f) * (y - y0_f)), -1)
+    output = tf.add_n([wa * Ia, wb * Ib, wc * Ic, wd * Id])
+
+    output = tf.reshape(output, tf.stack([num_batch, num_transforms, out_height, out_width, channels]))
+    return output